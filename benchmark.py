@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""CPU benchmarks: attention and kernels run the layers on random inputs, scaling and input use the prepro data.
+
+python benchmark.py attention [--lengths 600,1200,2400] [--window 64] [--global_tokens 0]
+python benchmark.py kernels [--length 600]
+python benchmark.py scaling [--workers 1,2,4] [--train_steps 200] [config.py flags ...]
+python benchmark.py input [--batches 500] [config.py flags ...]
+"""
+
+import os
+import sys
+import json as json
+import time
+import functools
+import argparse
+import resource
+import tempfile
+import subprocess
+
+
+# Self Attention
+# ----------------------------------------------------------------------------------------- #
+def _run_attention(length, window, global_tokens, batch_size, hidden, num_heads, steps):
+    # one training step of a 7-block model encoder (layers.residual_block) on random inputs
+    # output: {"step_ms", "peak_mb"}, measured in this process
+    import numpy as np
+    import tensorflow as tf
+    from layers import residual_block
+
+    inputs = tf.placeholder(tf.float32, [batch_size, None, hidden])
+    mask = tf.placeholder(tf.bool, [batch_size, None])
+    outputs = residual_block(inputs, num_blocks=7, num_conv_layers=2, kernel_size=5, mask=mask,
+                             num_filters=hidden, num_heads=num_heads, scope="Model_Encoder", bias=False,
+                             attention_window=window, global_tokens=global_tokens)
+    loss = tf.reduce_mean(tf.square(outputs))
+    train_op = tf.train.AdamOptimizer(1e-3).minimize(loss)
+    feed = {inputs: np.random.randn(batch_size, length, hidden).astype(np.float32),
+            mask: np.ones([batch_size, length], dtype=bool)}
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(train_op, feed_dict=feed)  # warm up
+        start = time.time()
+        for _ in range(steps):
+            sess.run(train_op, feed_dict=feed)
+        step_ms = (time.time() - start) * 1000.0 / steps
+    # ru_maxrss is in kilobytes on Linux
+    return {"step_ms": step_ms, "peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+
+def attention(args):
+    # every setting runs in its own process: the peak RSS of a process never goes down
+    print("{:>8} {:>12} {:>10} {:>10}".format("length", "attention", "step(ms)", "peak(MB)"))
+    for length in [int(length) for length in args.lengths.split(",")]:
+        for window in (0, args.window):
+            cmd = [sys.executable, __file__, "attention_child", "--length", str(length), "--window", str(window),
+                   "--global_tokens", str(args.global_tokens if window else 0), "--batch_size", str(args.batch_size),
+                   "--hidden", str(args.hidden), "--num_heads", str(args.num_heads), "--steps", str(args.steps)]
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+            name = "local({})".format(window) if window else "full"
+            if proc.returncode != 0:
+                # full attention at long lengths may be killed for running out of memory
+                print("{:>8} {:>12} {:>10} {:>10}".format(length, name, "failed", "-"))
+                continue
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            print("{:>8} {:>12} {:>10.1f} {:>10.0f}".format(length, name, result["step_ms"], result["peak_mb"]))
+
+
+def attention_child(args):
+    print(json.dumps(_run_attention(args.length, args.window, args.global_tokens, args.batch_size,
+                                    args.hidden, args.num_heads, args.steps)))
+
+
+# Timing Signal and Layer Norm
+# ----------------------------------------------------------------------------------------- #
+def _run_kernels(length, batch_size, hidden, num_heads, steps, cached):
+    # output: {"ops", "step_ms"} of a 7-block model encoder forward pass
+    import numpy as np
+    import tensorflow as tf
+    import layers
+
+    if not cached:
+        # the per-step sin/cos tables and the four-op layer norm
+        layers.add_timing_signal_1d = functools.partial(layers.add_timing_signal_1d, cached=False)
+        layers.norm_fn = functools.partial(layers.layer_norm, fused=False)
+    inputs = tf.placeholder(tf.float32, [batch_size, None, hidden])
+    mask = tf.placeholder(tf.bool, [batch_size, None])
+    outputs = layers.residual_block(inputs, num_blocks=7, num_conv_layers=2, kernel_size=5, mask=mask,
+                                    num_filters=hidden, num_heads=num_heads, scope="Model_Encoder", bias=False)
+    ops = len(tf.get_default_graph().get_operations())
+    feed = {inputs: np.random.randn(batch_size, length, hidden).astype(np.float32),
+            mask: np.ones([batch_size, length], dtype=bool)}
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(outputs, feed_dict=feed)  # warm up
+        start = time.time()
+        for _ in range(steps):
+            sess.run(outputs, feed_dict=feed)
+        step_ms = (time.time() - start) * 1000.0 / steps
+    return {"ops": ops, "step_ms": step_ms}
+
+
+def kernels(args):
+    print("{:>10} {:>8} {:>10}".format("kernels", "ops", "step(ms)"))
+    for cached in (False, True):
+        cmd = [sys.executable, __file__, "kernels_child", "--length", str(args.length),
+               "--batch_size", str(args.batch_size), "--hidden", str(args.hidden),
+               "--num_heads", str(args.num_heads), "--steps", str(args.steps)] + (["--cached"] if cached else [])
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        print("{:>10} {:>8} {:>10.1f}".format("cached" if cached else "original", result["ops"], result["step_ms"]))
+
+
+def kernels_child(args):
+    print(json.dumps(_run_kernels(args.length, args.batch_size, args.hidden, args.num_heads, args.steps, args.cached)))
+
+
+# Data-parallel Scaling
+# ----------------------------------------------------------------------------------------- #
+def scaling(args, extra):
+    # train with config.py --mode distributed for each number of workers on the prepro data,
+    # efficiency = examples/sec / (workers * examples/sec of one worker)
+    config_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.py")
+    print("{:>8} {:>14} {:>8} {:>11} {:>18}".format("workers", "examples/sec", "speedup", "efficiency",
+                                                    "added worker gain"))
+    single = previous = None
+    for i, workers in enumerate([int(workers) for workers in args.workers.split(",")]):
+        run_dir = tempfile.mkdtemp(prefix="scaling_{}_".format(workers))
+        log_dir, save_dir = os.path.join(run_dir, "event"), os.path.join(run_dir, "model")
+        os.makedirs(log_dir)
+        os.makedirs(save_dir)
+        cmd = [sys.executable, config_py, "--mode=distributed", "--num_workers={}".format(workers),
+               "--num_steps={}".format(args.train_steps), "--checkpoint={}".format(args.train_steps),
+               "--log_dir={}".format(log_dir), "--save_dir={}".format(save_dir),
+               "--dist_port={}".format(args.port + 100 * i)] + extra
+        subprocess.run(cmd, check=True)
+        with open(os.path.join(log_dir, "throughput.json"), "r") as fh:
+            throughput = json.load(fh)["examples_per_sec"]
+        if single is None:
+            single = throughput / workers
+        gain = "-" if previous is None else "{:+.1f}".format(throughput - previous)
+        print("{:>8} {:>14.1f} {:>8.2f} {:>11.2f} {:>18}".format(workers, throughput, throughput / single,
+                                                                 throughput / (workers * single), gain))
+        previous = throughput
+
+
+# Input Pipeline
+# ----------------------------------------------------------------------------------------- #
+def input_pipeline(args, extra):
+    # examples/sec of the train and dev tf.data pipelines alone, no model: compare them with the
+    # examples/sec of a training step to see whether the model ever waits for its input
+    import numpy as np
+    import tensorflow as tf
+    from config import flags
+    from util import get_record_parser, get_batch_dataset, get_dataset, get_bucket_boundaries
+
+    config = flags.FLAGS
+    config(sys.argv[:1] + ["--batch_size={}".format(args.batch_size)] + extra)
+    bucket_boundaries = None
+    if config.is_bucket and os.path.exists(config.train_meta):
+        with open(config.train_meta, "r") as fh:
+            bucket_boundaries = get_bucket_boundaries(json.load(fh).get("context_len_hist", []), config.num_buckets)
+    pipelines = [("train", lambda: get_batch_dataset(config.train_record_file, get_record_parser(config), config,
+                                                     bucket_boundaries)),
+                 ("dev", lambda: get_dataset(config.dev_record_file, config, cache=config.cache_dev))]
+    print("{:>6} {:>14} {:>14} {:>12}".format("data", "examples/sec", "tokens/sec", "batches/sec"))
+    for name, build in pipelines:
+        with tf.Graph().as_default():
+            batch = build().make_one_shot_iterator().get_next()
+            with tf.Session() as sess:
+                # fill the shuffle and prefetch buffers first
+                for _ in range(args.warmup_batches):
+                    sess.run(batch)
+                examples = tokens = 0
+                start = time.time()
+                for _ in range(args.batches):
+                    context_idxs = sess.run(batch)[0]
+                    examples += context_idxs.shape[0]
+                    tokens += np.count_nonzero(context_idxs)
+                seconds = time.time() - start
+        print("{:>6} {:>14.1f} {:>14.1f} {:>12.1f}".format(name, examples / seconds, tokens / seconds,
+                                                           args.batches / seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=["attention", "attention_child", "kernels", "kernels_child", "scaling",
+                                              "input"])
+    parser.add_argument("--lengths", default="600,1200,2400")
+    parser.add_argument("--length", type=int, default=600)
+    parser.add_argument("--window", type=int, default=64)
+    parser.add_argument("--global_tokens", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--hidden", type=int, default=96)
+    parser.add_argument("--num_heads", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--cached", action="store_true")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--train_steps", type=int, default=200)
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--batches", type=int, default=500)
+    parser.add_argument("--warmup_batches", type=int, default=50)
+    args, extra = parser.parse_known_args()
+    # unknown flags are config.py flags of the training runs or input pipelines
+    if args.benchmark == "scaling":
+        scaling(args, extra)
+        return
+    if args.benchmark == "input":
+        input_pipeline(args, extra)
+        return
+    if extra:
+        parser.error("unrecognized arguments: {}".format(" ".join(extra)))
+    {"attention": attention, "attention_child": attention_child,
+     "kernels": kernels, "kernels_child": kernels_child}[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,6 @@
 
 import os
 import tensorflow as tf
-from prepro import prepro
-from main import train, test
 
 
 # Configuration
@@ -30,16 +28,22 @@ answer_dir = os.path.join(dir_name, "answer")
 train_record_file = os.path.join(target_dir, "train.tfrecords")
 dev_record_file = os.path.join(target_dir, "dev.tfrecords")
 test_record_file = os.path.join(target_dir, "test.tfrecords")
-word_emb_file = os.path.join(target_dir, "word_emb.json")
+word_emb_file = os.path.join(target_dir, "word_emb.npy")
 char_emb_file = os.path.join(target_dir, "char_emb.json")
-train_eval = os.path.join(target_dir, "train_eval.json")
-dev_eval = os.path.join(target_dir, "dev_eval.json")
-test_eval = os.path.join(target_dir, "test_eval.json")
+emb_cache_dir = os.path.join(target_dir, "emb_cache")
+prepro_cache_dir = os.path.join(target_dir, "prepro_cache")
+train_eval = os.path.join(target_dir, "train_eval")
+dev_eval = os.path.join(target_dir, "dev_eval")
+test_eval = os.path.join(target_dir, "test_eval")
+train_meta = os.path.join(target_dir, "train_meta.json")
 dev_meta = os.path.join(target_dir, "dev_meta.json")
 test_meta = os.path.join(target_dir, "test_meta.json")
 word_dictionary = os.path.join(target_dir, "word_dictionary.json")
 char_dictionary = os.path.join(target_dir, "char_dictionary.json")
 answer_file = os.path.join(answer_dir, "answer.json")
+frozen_graph_file = os.path.join(dir_name, "frozen_model.pb")
+infer_file = os.path.join(target_dir, "infer.jsonl")
+infer_out_file = os.path.join(answer_dir, "infer_answer.jsonl")
 if not os.path.exists(train_dir):
     os.mkdir(train_dir)
 if not os.path.exists(os.path.join(os.getcwd(), dir_name)):
@@ -57,7 +61,7 @@ if not os.path.exists(answer_dir):
 # ----------------------------------------------------------------------------------------- #
 flags = tf.flags
 # settings for directories
-flags.DEFINE_string("mode", "train", "Running mode prepro/train/test")
+flags.DEFINE_string("mode", "train", "Running mode prepro/train/distributed/evaluate/test/infer/export")
 flags.DEFINE_string("target_dir", target_dir, "Target directory for out data")
 flags.DEFINE_string("log_dir", log_dir, "Directory for tf event")
 flags.DEFINE_string("save_dir", save_dir, "Directory for saving model")
@@ -72,9 +76,12 @@ flags.DEFINE_string("test_record_file", test_record_file, "Out file for test dat
 flags.DEFINE_string("train_eval_file", train_eval, "Out file for train eval")
 flags.DEFINE_string("dev_eval_file", dev_eval, "Out file for dev eval")
 flags.DEFINE_string("test_eval_file", test_eval, "Out file for test eval")
+flags.DEFINE_string("train_meta", train_meta, "Out file for train meta")
 flags.DEFINE_string("dev_meta", dev_meta, "Out file for dev meta")
 flags.DEFINE_string("test_meta", test_meta, "Out file for test meta")
 flags.DEFINE_string("answer_file", answer_file, "Out file for answer")
+flags.DEFINE_string("infer_file", infer_file, "JSONL file of {context, question} records for infer mode")
+flags.DEFINE_string("infer_out_file", infer_out_file, "JSONL file of answers written by infer mode, in input order")
 
 # settings for embeddings
 flags.DEFINE_string("glove_word_file", glove_word_file, "Glove word embedding source file")
@@ -82,11 +89,15 @@ flags.DEFINE_integer("glove_word_size", 8824330, "Corpus size for Glove")
 flags.DEFINE_integer("glove_dim", 200, "Embedding dimension for Glove")
 flags.DEFINE_string("word_emb_file", word_emb_file, "Out file for word embedding")
 flags.DEFINE_string("word_dictionary", word_dictionary, "Word dictionary")
+flags.DEFINE_integer("emb_workers", 4, "Number of processes parsing the embedding source file")
+flags.DEFINE_string("emb_cache_dir", emb_cache_dir, "Cache of filtered embeddings keyed on the vocabulary hash, empty to disable")
+flags.DEFINE_boolean("word_mat_in_graph", False, "Embed the word embedding table as a graph constant instead of a fed variable")
 
 # settings for lengths
 flags.DEFINE_integer("para_limit", 600, "Limit length for paragraph")
 flags.DEFINE_integer("ques_limit", 20, "Limit length for question")
 flags.DEFINE_integer("ans_limit", 16, "Limit length for answers")
+flags.DEFINE_integer("test_ans_limit", 100, "Limit length for answers in test file")
 flags.DEFINE_integer("test_para_limit", 600, "Limit length for paragraph in test file")
 flags.DEFINE_integer("test_ques_limit", 20, "Limit length for question in test file")
 flags.DEFINE_integer("word_count_limit", -1, "Min count for word")
@@ -94,15 +105,23 @@ flags.DEFINE_integer("word_count_limit", -1, "Min count for word")
 # settings for process
 flags.DEFINE_integer("capacity", 15000, "Batch size of dataset shuffle")
 flags.DEFINE_integer("num_threads", 4, "Number of threads in input pipeline")
+flags.DEFINE_integer("prefetch_batches", 0, "Batches prefetched by the input pipelines, 0 to let tf.data tune it")
+flags.DEFINE_boolean("cache_dev", False, "Keep the serialized dev records in memory after the first pass")
+flags.DEFINE_integer("prepro_workers", 4, "Number of processes used by prepro")
+flags.DEFINE_integer("num_shards", 4, "Number of TFRecord shards written per split")
+flags.DEFINE_string("prepro_cache_dir", prepro_cache_dir, "Cache of prepro stages keyed on their inputs, empty to disable")
 flags.DEFINE_boolean("is_bucket", False, "build bucket batch iterator or not")
-flags.DEFINE_list("bucket_range", [40, 401, 40], "the range of bucket")
+flags.DEFINE_list("bucket_range", [40, 401, 40], "the range of bucket, used when train meta has no length histogram")
+flags.DEFINE_integer("num_buckets", 8, "Number of equal-frequency buckets derived from the train length histogram")
 
 # settings for model
 flags.DEFINE_integer("batch_size", 16, "Batch size")
+flags.DEFINE_integer("accum_steps", 1, "Micro-batches of batch_size whose gradients are summed per update (train mode)")
 flags.DEFINE_integer("num_steps", 120000, "Number of steps")
 flags.DEFINE_integer("checkpoint", 1000, "checkpoint to save and evaluate the model")
 flags.DEFINE_integer("period", 100, "period to save batch loss")
 flags.DEFINE_integer("val_num_batches", 150, "Number of batches to evaluate the model")
+flags.DEFINE_integer("eval_workers", 4, "Processes scoring EM/F1 of the evaluation answers")
 flags.DEFINE_float("dropout", 0.2, "Dropout prob across the layers")
 flags.DEFINE_float("grad_clip", 5.0, "Global Norm gradient clipping rate")
 flags.DEFINE_float("learning_rate", 0.001, "Learning rate")
@@ -110,7 +129,42 @@ flags.DEFINE_float("decay", 0.9999, "Exponential moving average decay")
 flags.DEFINE_float("l2_norm", 3e-7, "L2 norm scale")
 flags.DEFINE_integer("hidden", 96, "Hidden size")
 flags.DEFINE_integer("num_heads", 1, "Number of heads in self attention")
+flags.DEFINE_integer("emb_attention_window", 0, "Block size of local self attention in the context embedding encoder, 0 for full attention")
+flags.DEFINE_integer("model_attention_window", 0, "Block size of local self attention in the model encoder, 0 for full attention")
+flags.DEFINE_integer("attention_global_tokens", 0, "Leading context tokens attending to and attended by every position in local attention")
 flags.DEFINE_integer("early_stop", 20, "Checkpoints for early stop")
+flags.DEFINE_boolean("async_eval", False, "Skip the evaluation in the train loop, checkpoints are scored by --mode evaluate")
+flags.DEFINE_boolean("spawn_evaluator", True, "With --async_eval, start the --mode evaluate process from train")
+flags.DEFINE_integer("eval_poll_secs", 60, "Seconds the evaluator waits for a new checkpoint before checking whether train is done")
+flags.DEFINE_integer("num_workers", 2, "Worker processes started by the distributed mode")
+flags.DEFINE_integer("num_ps", 1, "Parameter server processes started by the distributed mode")
+flags.DEFINE_integer("dist_port", 2222, "First local port used by the processes of the distributed mode")
+flags.DEFINE_integer("dist_warmup_steps", 10, "Steps per worker left out of the distributed throughput report")
+flags.DEFINE_string("ps_hosts", "", "Comma separated host:port of the parameter servers, set by the distributed mode")
+flags.DEFINE_string("worker_hosts", "", "Comma separated host:port of the workers, set by the distributed mode")
+flags.DEFINE_string("job_name", "worker", "ps or worker, set by the distributed mode")
+flags.DEFINE_integer("task_index", 0, "Index of the task within its job, set by the distributed mode")
+flags.DEFINE_string("span_decoder", "outer", "Span decoding: outer (any length, full length x length product) or banded "
+                    "(spans up to ans_limit tokens, test_ans_limit in test mode; longer answers are never predicted)")
+flags.DEFINE_integer("top_k", 5, "Number of answer spans decoded per example")
+
+# settings for serving
+flags.DEFINE_integer("batch_max_size", 16, "Max number of requests stacked into one inference batch")
+flags.DEFINE_float("batch_timeout_ms", 5.0, "Max milliseconds to wait for more requests before running a batch")
+flags.DEFINE_integer("doc_window", 600, "Max context tokens per window at inference, longer contexts are split")
+flags.DEFINE_integer("doc_stride", 300, "Tokens between the starts of two consecutive context windows, at most doc_window")
+# a stride longer than the window would leave context tokens that no window covers
+flags.register_multi_flags_validator(["doc_window", "doc_stride"],
+                                     lambda values: 0 < values["doc_stride"] <= values["doc_window"],
+                                     message="--doc_stride must be between 1 and --doc_window")
+flags.DEFINE_integer("tokenizer_cache_size", 1024, "Contexts whose segmentation and ids server.py keeps in its LRU cache")
+flags.DEFINE_integer("context_cache_mb", 256, "Memory cap of the context encodings server.py keeps in its LRU cache, 0 disables it")
+flags.DEFINE_integer("infer_chunk_size", 10000, "Records tokenized and predicted together in infer mode")
+flags.DEFINE_integer("infer_workers", 4, "Number of tokenizer processes in infer mode")
+flags.DEFINE_string("frozen_graph_file", frozen_graph_file, "Frozen inference graph written by export mode")
+flags.DEFINE_boolean("use_frozen_graph", False, "Serve predict.py/server.py from the frozen graph instead of the checkpoint")
+flags.DEFINE_string("quantize", "none", "Quantization of the exported graph: none/float16/int8_weights/int8")
+flags.DEFINE_integer("quant_calib_batches", 20, "Dev batches used to calibrate int8 ranges and report the EM/F1 change, 0 to skip")
 
 # extensions (Uncomment corresponding code in download.sh to download the required data)
 fasttext_file = os.path.join(home, "data", "fasttext", "wiki-news-300d-1M.vec")
@@ -123,13 +177,33 @@ flags.DEFINE_boolean("fasttext", False, "Whether to use fasttext")
 # Set path
 # ----------------------------------------------------------------------------------------- #
 def main(_):
+    # modes are imported lazily: predict.py and server.py import the flags from here and
+    # must not pull in model.py/layers.py when they serve a frozen graph
     config = flags.FLAGS
     if config.mode == "train":
+        from main import train
         train(config)
+    elif config.mode == "distributed":
+        from distributed import launch
+        launch(config)
+    elif config.mode == "train_replica":
+        from distributed import train_replica
+        train_replica(config)
+    elif config.mode == "evaluate":
+        from main import evaluate_checkpoints
+        evaluate_checkpoints(config)
     elif config.mode == "prepro":
+        from prepro import prepro
         prepro(config)
     elif config.mode == "test":
+        from main import test
         test(config)
+    elif config.mode == "infer":
+        from infer import infer
+        infer(config)
+    elif config.mode == "export":
+        from export import export
+        export(config)
     else:
         print("Unknown mode")
         exit(0)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import json as json
+import subprocess
+import tensorflow as tf
+
+from model import Model
+from util import get_record_parser, get_batch_dataset, load_embedding, get_bucket_boundaries, argv_without_mode
+
+
+# Optimizers
+# ----------------------------------------------------------------------------------------- #
+class ClippedOptimizer(tf.train.Optimizer):
+    """Clip the gradients by their global norm before the wrapped optimizer applies them.
+
+    Wrapped by tf.train.SyncReplicasOptimizer, apply_gradients receives the gradients
+    averaged over the replicas, so the norm is that of the aggregated update.
+    """
+    def __init__(self, opt, clip_norm, name="ClippedOptimizer"):
+        super(ClippedOptimizer, self).__init__(use_locking=False, name=name)
+        self._opt = opt
+        self._clip_norm = clip_norm
+
+    def compute_gradients(self, *args, **kwargs):
+        return self._opt.compute_gradients(*args, **kwargs)
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        gradients, variables = zip(*grads_and_vars)
+        capped_grads, _ = tf.clip_by_global_norm(gradients, self._clip_norm)
+        return self._opt.apply_gradients(zip(capped_grads, variables), global_step=global_step, name=name)
+
+    def get_slot(self, *args, **kwargs):
+        return self._opt.get_slot(*args, **kwargs)
+
+    def get_slot_names(self, *args, **kwargs):
+        return self._opt.get_slot_names(*args, **kwargs)
+
+    def variables(self):
+        return self._opt.variables()
+
+
+def sync_optimizer(config, num_workers):
+    # output: an optimizer_fn for Model, aggregating the gradients of num_workers replicas per step,
+    #         then clipping them and applying Adam and the EMA once on the parameter servers
+    def wrap(opt, var_ema):
+        return tf.train.SyncReplicasOptimizer(ClippedOptimizer(opt, config.grad_clip),
+                                              replicas_to_aggregate=num_workers, total_num_replicas=num_workers,
+                                              variable_averages=var_ema,
+                                              variables_to_average=tf.trainable_variables() if var_ema else None)
+    return wrap
+
+
+# Cluster
+# ----------------------------------------------------------------------------------------- #
+def get_cluster(config):
+    # --ps_hosts/--worker_hosts are comma separated host:port lists, the same in every process
+    return tf.train.ClusterSpec({"ps": config.ps_hosts.split(","), "worker": config.worker_hosts.split(",")})
+
+
+def _device_fn(config, cluster):
+    worker_device = "/job:worker/task:{}".format(config.task_index)
+    setter = tf.train.replica_device_setter(worker_device=worker_device, cluster=cluster)
+
+    def device_fn(op):
+        # the embedding table is read-only and fed locally, keep it off the parameter servers
+        if op.name.split("/")[0] in ("word_mat", "word_mat_value"):
+            return worker_device
+        return setter(op)
+    return device_fn
+
+
+def train_replica(config):
+    # one ps or worker process of the cluster; worker 0 is the chief, it initializes, saves and summarizes
+    cluster = get_cluster(config)
+    server = tf.train.Server(cluster, job_name=config.job_name, task_index=config.task_index)
+    if config.job_name == "ps":
+        server.join()
+        return
+    num_workers = cluster.num_tasks("worker")
+    is_chief = config.task_index == 0
+
+    word_mat = load_embedding(config.word_emb_file)
+    bucket_boundaries = None
+    if config.is_bucket and os.path.exists(config.train_meta):
+        with open(config.train_meta, "r") as fh:
+            train_meta = json.load(fh)
+        if "context_len_hist" in train_meta:
+            bucket_boundaries = get_bucket_boundaries(train_meta["context_len_hist"], config.num_buckets)
+
+    graph = tf.Graph()
+    with graph.as_default() as g:
+        with tf.device(_device_fn(config, cluster)):
+            # every worker reads its own part of the train records
+            dataset = get_batch_dataset(config.train_record_file, get_record_parser(config), config, bucket_boundaries,
+                                        num_shards=num_workers, shard_index=config.task_index)
+            model = Model(config, dataset.make_one_shot_iterator(), word_mat, graph=g,
+                          optimizer_fn=sync_optimizer(config, num_workers))
+        other_locals = [var for var in tf.local_variables() if var is not model.word_mat]
+        # word_mat is initialized from its placeholder after the session exists, not by the scaffold
+        scaffold = tf.train.Scaffold(ready_op=tf.report_uninitialized_variables(tf.global_variables()),
+                                     local_init_op=tf.group(tf.variables_initializer(other_locals),
+                                                            tf.tables_initializer()),
+                                     saver=tf.train.Saver(max_to_keep=5))
+        hooks = [model.opt.make_session_run_hook(is_chief), tf.train.StopAtStepHook(last_step=config.num_steps)]
+        sess_config = tf.ConfigProto(allow_soft_placement=True,
+                                     device_filters=["/job:ps", "/job:worker/task:{}".format(config.task_index)])
+
+        writer = tf.summary.FileWriter(config.log_dir) if is_chief else None
+        steps = 0
+        start = None
+        with tf.train.MonitoredTrainingSession(master=server.target, is_chief=is_chief, checkpoint_dir=config.save_dir,
+                                               scaffold=scaffold, hooks=hooks, save_checkpoint_secs=None,
+                                               save_checkpoint_steps=config.checkpoint if is_chief else None,
+                                               save_summaries_steps=None, save_summaries_secs=None,
+                                               config=sess_config) as sess:
+            if model.word_mat_init is not None:
+                sess.run(model.word_mat_init, feed_dict={model.word_mat_ph: model.word_mat_value})
+            while not sess.should_stop():
+                # the first steps wait for every replica to join, they are not counted
+                if steps == config.dist_warmup_steps:
+                    start = time.time()
+                loss, _, global_step = sess.run([model.loss, model.train_op, model.global_step],
+                                                feed_dict={model.dropout: config.dropout})
+                steps += 1
+                if is_chief and global_step % config.period == 0:
+                    writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="model/loss", simple_value=loss)]),
+                                       global_step)
+        if writer is not None:
+            writer.close()
+
+    counted = max(steps - config.dist_warmup_steps, 0)
+    seconds = time.time() - start if start is not None else 0.
+    stats = {"task_index": config.task_index, "steps": counted, "seconds": seconds,
+             "examples_per_sec": counted * config.batch_size / seconds if seconds > 0 else 0.}
+    with open(os.path.join(config.log_dir, "worker_{}.json".format(config.task_index)), "w") as fh:
+        json.dump(stats, fh)
+
+
+# Local Launcher
+# ----------------------------------------------------------------------------------------- #
+def launch(config):
+    # run --num_ps parameter servers and --num_workers workers on this machine, each in its own process,
+    # then report the training throughput of the cluster
+    ports = range(config.dist_port, config.dist_port + config.num_ps + config.num_workers)
+    hosts = ["localhost:{}".format(port) for port in ports]
+    ps_hosts, worker_hosts = ",".join(hosts[:config.num_ps]), ",".join(hosts[config.num_ps:])
+    # every flag given to the launcher but --mode is passed on to the replicas
+    argv = argv_without_mode()
+
+    def start(job_name, task_index):
+        return subprocess.Popen([sys.executable, sys.argv[0]] + argv +
+                                ["--mode=train_replica", "--job_name={}".format(job_name),
+                                 "--task_index={}".format(task_index), "--ps_hosts={}".format(ps_hosts),
+                                 "--worker_hosts={}".format(worker_hosts)])
+
+    ps = [start("ps", i) for i in range(config.num_ps)]
+    workers = [start("worker", i) for i in range(config.num_workers)]
+    codes = [worker.wait() for worker in workers]
+    for p in ps:
+        p.terminate()
+        p.wait()
+    if any(codes):
+        raise RuntimeError("workers exited with codes {}".format(codes))
+
+    stats = []
+    for i in range(config.num_workers):
+        with open(os.path.join(config.log_dir, "worker_{}.json".format(i)), "r") as fh:
+            stats.append(json.load(fh))
+    report = {"num_workers": config.num_workers, "num_ps": config.num_ps,
+              "examples_per_sec": sum(stat["examples_per_sec"] for stat in stats), "workers": stats}
+    with open(os.path.join(config.log_dir, "throughput.json"), "w") as fh:
+        json.dump(report, fh)
+    print("{} workers: {:.1f} examples/sec".format(config.num_workers, report["examples_per_sec"]))
+    return report
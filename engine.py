@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+import time
+import hashlib
+import threading
+import numpy as np
+from queue import Queue, Empty
+from collections import OrderedDict
+
+from preprocess import split_windows
+
+
+# Batch Helpers
+# ----------------------------------------------------------------------------------------- #
+def pad_batch(seqs):
+    # input: seqs: a list of 1-D index arrays with different lengths
+    # output: an int32 array [len(seqs), max_len], right-padded with 0 (--NULL--)
+    max_len = max(len(seq) for seq in seqs)
+    batch = np.zeros([len(seqs), max_len], dtype=np.int32)
+    for i, seq in enumerate(seqs):
+        batch[i, :len(seq)] = seq
+    return batch
+
+
+def length_groups(*seq_lists):
+    # input: seq_lists: aligned lists of sequences
+    # output: lists of indices whose sequences all have the same lengths, in order of first appearance
+    groups = OrderedDict()
+    for i, seqs in enumerate(zip(*seq_lists)):
+        groups.setdefault(tuple(len(seq) for seq in seqs), []).append(i)
+    return list(groups.values())
+
+
+def run_batch(sess, model, contexts, questions, encodings=None):
+    # input: sess: a tf.Session holding the restored demo model,
+    #        model: a Model built with demo=True,
+    #        contexts: a list of 1-D context index arrays,
+    #        questions: a list of 1-D question index arrays,
+    #        encodings: optional context encodings from encode_contexts, one per context; the context
+    #                   embedding and encoder are then not run
+    # output: one list of up to top_k (start, end, prob) token spans per pair, best first, as decoded in-graph
+    # The convolutions do not mask their inputs, so padding would change the encodings of the last
+    # tokens of a shorter context or question: only pairs of the same lengths share a sess.run, and
+    # the answer to a pair does not depend on the rest of the batch.
+    spans = [None] * len(contexts)
+    for group in length_groups(contexts, questions):
+        feed_dict = {model.c: pad_batch([contexts[i] for i in group]), model.q: pad_batch([questions[i] for i in group])}
+        if encodings is not None:
+            # the encodings of a group have the same length, they are stacked without padding
+            feed_dict[model.c_enc] = np.stack([encodings[i] for i in group])
+        starts, ends, probs = sess.run([model.yp_starts, model.yp_ends, model.yp_probs], feed_dict=feed_dict)
+        for i, span in zip(group, zip(starts.tolist(), ends.tolist(), probs.tolist())):
+            # a context with fewer than top_k spans gets the rest from its padding, with a probability of 0
+            spans[i] = [(start, end, prob) for start, end, prob in zip(*span)
+                        if start <= end < len(contexts[i]) and prob > 0]
+    return spans
+
+
+def encode_contexts(sess, model, contexts):
+    # input: contexts: a list of 1-D context index arrays
+    # output: their [len, hidden] embedding encoder outputs, which do not depend on any question
+    # contexts of the same length are encoded together, as run_batch would encode them: no padding,
+    # so a cached encoding is the one computed without the cache, whatever else was in the batch
+    encodings = [None] * len(contexts)
+    for group in length_groups(contexts):
+        for i, encoding in zip(group, sess.run(model.c_enc, feed_dict={model.c: pad_batch([contexts[i] for i in group])})):
+            encodings[i] = encoding
+    return encodings
+
+
+def context_key(context):
+    # the cache key of a context window: a digest of its token indices
+    return hashlib.sha1(np.ascontiguousarray(context, dtype=np.int32).tobytes()).hexdigest()
+
+
+def merge_windows(windows, spans, top_k=1):
+    # input: windows: (start, end) token ranges from preprocess.split_windows,
+    #        spans: the (start, end, prob) spans predicted for each window
+    # output: the top_k spans across windows, positions relative to the whole context, best first
+    best = {}
+    for (offset, _), window_spans in zip(windows, spans):
+        for start, end, prob in window_spans:
+            key = (offset + start, offset + end)
+            # overlapping windows may find the same span, keep its best probability
+            if prob > best.get(key, -1.):
+                best[key] = prob
+    merged = sorted(((start, end, prob) for (start, end), prob in best.items()), key=lambda span: -span[2])
+    return merged[:top_k]
+
+
+# Context Encoding Cache
+# ----------------------------------------------------------------------------------------- #
+class ContextEncodingCache(object):
+    """LRU cache of context encodings, keyed by context_key and bounded by their total size.
+
+    Only the engine worker thread uses it, so it needs no lock.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._encodings = OrderedDict()
+
+    def __len__(self):
+        return len(self._encodings)
+
+    def get(self, key):
+        encoding = self._encodings.get(key)
+        if encoding is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._encodings.move_to_end(key)
+        return encoding
+
+    def put(self, key, encoding):
+        if key in self._encodings or encoding.nbytes > self.max_bytes:
+            return
+        self._encodings[key] = encoding
+        self.nbytes += encoding.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._encodings.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+
+# Micro-batching Engine
+# ----------------------------------------------------------------------------------------- #
+class _Request(object):
+    def __init__(self, context, question, key=None):
+        self.context = context
+        self.question = question
+        self.key = key
+        self.value = None
+        self.error = None
+        self._done = threading.Event()
+
+    def set_result(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self._done.set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("inference request timed out")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class BatchInferenceEngine(object):
+    """Collect concurrent requests and answer them with one sess.run per length group of a micro-batch.
+
+    A single worker thread owns the session: it blocks for the first request, then keeps
+    collecting until max_batch_size requests are queued or max_wait_ms has passed since
+    the first one arrived, and runs the requests with the same context and question lengths
+    together (see run_batch), so an answer does not depend on concurrent traffic.
+
+    With cache_bytes > 0 the context encodings are kept in a ContextEncodingCache: the contexts
+    of a batch missing from it are encoded first, once each, and the batch is answered from
+    the cached encodings, so repeated passages only pay for the question-dependent layers.
+    """
+    def __init__(self, sess, model, max_batch_size=16, max_wait_ms=5.0, cache_bytes=0):
+        self.sess = sess
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        # frozen graphs exported before the context encoding was named cannot use the cache
+        use_cache = cache_bytes > 0 and getattr(model, "c_enc", None) is not None
+        self.cache = ContextEncodingCache(cache_bytes) if use_cache else None
+        self._queue = Queue()
+        self._worker = threading.Thread(target=self._loop, name="batch_inference_engine")
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, context, question):
+        # input: context, question: 1-D index arrays (without padding)
+        # output: a request whose result() is the list of (start, end, prob) spans of this pair, best first
+        request = _Request(context, question, context_key(context) if self.cache is not None else None)
+        self._queue.put(request)
+        return request
+
+    def infer(self, context, question, timeout=None):
+        return self.submit(context, question).result(timeout)
+
+    def infer_windows(self, context, question, window, stride, top_k=1, timeout=None):
+        # contexts longer than window are split into overlapping windows queued together,
+        # so they usually share one batch, and the top_k spans across windows are kept
+        windows = split_windows(len(context), window, stride)
+        requests = [self.submit(context[start: end], question) for start, end in windows]
+        return merge_windows(windows, [request.result(timeout) for request in requests], top_k)
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except Empty:
+                break
+            if request is None:
+                # finish the current batch before shutting down
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                encodings = self._encodings(batch) if self.cache is not None else None
+                spans = run_batch(self.sess, self.model,
+                                  [request.context for request in batch],
+                                  [request.question for request in batch], encodings)
+            except Exception as e:
+                for request in batch:
+                    request.set_result(error=e)
+                continue
+            for request, span in zip(batch, spans):
+                request.set_result(value=span)
+
+    def _encodings(self, batch):
+        # output: the context encoding of every request, from the cache or encoded in one sess.run
+        found, missing = {}, OrderedDict()
+        for request in batch:
+            if request.key in found or request.key in missing:
+                continue
+            encoding = self.cache.get(request.key)
+            if encoding is None:
+                missing[request.key] = request.context
+            else:
+                found[request.key] = encoding
+        if missing:
+            for key, encoding in zip(missing, encode_contexts(self.sess, self.model, list(missing.values()))):
+                # copy the row, the cache must not keep the whole group output alive
+                encoding = np.array(encoding)
+                found[key] = encoding
+                self.cache.put(key, encoding)
+        return [found[request.key] for request in batch]
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import json as json
+import tensorflow as tf
+
+from util import load_embedding, get_dataset, convert_tokens, evaluate, EvalStore
+
+QUANTIZE_MODES = ("none", "float16", "int8_weights", "int8")
+
+
+# Freeze
+# ----------------------------------------------------------------------------------------- #
+def freeze(config, word_mat):
+    # output: graph_def: the frozen inference graph, EMA weights folded in and constants folded,
+    #         names: the tensor and op names FrozenModel needs to feed and fetch
+    from model import Model
+
+    graph = tf.Graph()
+    model = Model(config, word_mat=word_mat, trainable=False, opt=False, demo=True, graph=graph)
+    with graph.as_default():
+        sess_config = tf.ConfigProto(allow_soft_placement=True)
+        sess_config.gpu_options.allow_growth = True
+        with tf.Session(config=sess_config) as sess:
+            sess.run(tf.global_variables_initializer())
+            model.init_word_mat(sess)
+            saver = tf.train.Saver()
+            saver.restore(sess, tf.train.latest_checkpoint(config.save_dir))
+            # fold the EMA shadows into the weights before they become constants
+            if config.decay < 1.0:
+                sess.run(model.assign_vars)
+
+            names = {"context": model.c.name, "question": model.q.name, "yp1": model.yp1.name,
+                     "yp2": model.yp2.name, "yp_score": model.yp_score.name, "yp_starts": model.yp_starts.name,
+                     "yp_ends": model.yp_ends.name, "yp_probs": model.yp_probs.name,
+                     "context_encoding": model.c_enc.name, "word_mat_init": None, "word_mat_value": None}
+            # the context encoding is both fetched and fed by engine.ContextEncodingCache, keep it named
+            outputs = [t.op.name for t in (model.yp1, model.yp2, model.yp_score, model.yp_starts, model.yp_ends, model.yp_probs,
+                                           model.c_enc)]
+            blacklist = None
+            if model.word_mat_init is not None:
+                # the embedding table stays a variable fed at load time, the GraphDef only holds the network
+                names["word_mat_init"] = model.word_mat_init.name
+                names["word_mat_value"] = model.word_mat_ph.name
+                outputs.append(model.word_mat_init.name)
+                blacklist = [model.word_mat.op.name]
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), outputs,
+                                                                     variable_names_blacklist=blacklist)
+    names["outputs"] = outputs
+    names["inputs"] = [model.c.op.name, model.q.op.name]
+
+    # the model was built with dropout as a python 0.0, so the graph has no dropout branches left;
+    # prune everything the outputs do not need and fold the constant subgraphs
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, outputs)
+    graph_def = _transform(graph_def, names, ["remove_nodes(op=CheckNumerics)", "fold_constants(ignore_errors=true)",
+                                              "sort_by_execution_order"])
+    return graph_def, names
+
+
+def _transform(graph_def, names, transforms):
+    from tensorflow.tools.graph_transforms import TransformGraph
+    return TransformGraph(graph_def, names["inputs"], names["outputs"], transforms)
+
+
+def save_frozen_graph(graph_def, names, filename):
+    with tf.gfile.GFile(filename, "wb") as fh:
+        fh.write(graph_def.SerializeToString())
+    with open(filename + ".json", "w") as fh:
+        json.dump(names, fh)
+
+
+def load_frozen_graph(filename):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(filename, "rb") as fh:
+        graph_def.ParseFromString(fh.read())
+    with open(filename + ".json", "r") as fh:
+        names = json.load(fh)
+    return graph_def, names
+
+
+# Quantize
+# ----------------------------------------------------------------------------------------- #
+def float16_weights(graph_def, minimum_size=1024):
+    # store every large float32 constant as float16 followed by a Cast back to float32:
+    # weights take half the memory and the kernels still compute in float32
+    from tensorflow.python.framework import tensor_util
+
+    output = tf.GraphDef()
+    output.versions.CopyFrom(graph_def.versions)
+    output.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.op == "Const" and node.attr["dtype"].type == tf.float32.as_datatype_enum:
+            value = tensor_util.MakeNdarray(node.attr["value"].tensor)
+            if value.size >= minimum_size:
+                const = output.node.add()
+                const.op = "Const"
+                const.name = node.name + "/float16"
+                const.device = node.device
+                const.attr["dtype"].type = tf.float16.as_datatype_enum
+                const.attr["value"].tensor.CopyFrom(tensor_util.make_tensor_proto(value.astype(np.float16)))
+                cast = output.node.add()
+                cast.op = "Cast"
+                cast.name = node.name
+                cast.device = node.device
+                cast.input.append(const.name)
+                cast.attr["SrcT"].type = tf.float16.as_datatype_enum
+                cast.attr["DstT"].type = tf.float32.as_datatype_enum
+                continue
+        output.node.add().CopyFrom(node)
+    return output
+
+
+def quantize(graph_def, names, mode, calibrate=None):
+    # input: graph_def, names: a frozen graph from freeze,
+    #        mode: one of QUANTIZE_MODES,
+    #        calibrate: a function running dev batches through a (graph_def, names) pair, used by int8
+    #                   to record the activation ranges; without it the ranges are computed per batch
+    # output: the quantized graph_def
+    if mode == "none":
+        return graph_def
+    if mode == "float16":
+        return float16_weights(graph_def)
+    # int8 weights are stored with their min/max and dequantized in the graph
+    graph_def = _transform(graph_def, names, ["quantize_weights(minimum_size=1024)"])
+    if mode == "int8_weights":
+        return graph_def
+    # int8: the supported ops (MatMul, Conv2D, Relu, ...) run on 8 bit activations quantized on the fly
+    graph_def = _transform(graph_def, names, ["quantize_nodes", "strip_unused_nodes", "sort_by_execution_order"])
+    if calibrate is None:
+        return graph_def
+    logged = _transform(graph_def, names, ['insert_logging(op=RequantizationRange, show_name=true, message="__requant_min_max:")'])
+    fd, log_file = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    # tf.Print writes from C++ to stderr, redirect the file descriptor while the dev batches run
+    sys.stderr.flush()
+    saved_stderr = os.dup(2)
+    log_fd = os.open(log_file, os.O_WRONLY | os.O_TRUNC)
+    os.dup2(log_fd, 2)
+    try:
+        calibrate(logged, names)
+    finally:
+        os.dup2(saved_stderr, 2)
+        os.close(log_fd)
+        os.close(saved_stderr)
+    graph_def = _transform(graph_def, names, ["freeze_requantization_ranges(min_max_log_file={})".format(log_file)])
+    os.remove(log_file)
+    return graph_def
+
+
+def load_dev_batches(config, num_batches):
+    graph = tf.Graph()
+    with graph.as_default():
+        batch = get_dataset(config.dev_record_file, config).make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            return [sess.run(batch) for _ in range(num_batches)]
+
+
+def evaluate_frozen(graph_def, names, word_mat, batches, eval_file):
+    # output: EM/F1 of the graph on the batches (util.evaluate) and its mean latency per batch
+    model = FrozenModel(graph_def, names, word_mat=word_mat)
+    with model.graph.as_default():
+        with tf.Session() as sess:
+            model.init_word_mat(sess)
+            answer_dict = {}
+            seconds = 0.
+            for c, q, _, _, qa_id in batches:
+                start = time.time()
+                yp1, yp2 = sess.run([model.yp1, model.yp2], feed_dict={model.c: c, model.q: q})
+                seconds += time.time() - start
+                answer_dict_, _ = convert_tokens(eval_file, qa_id, yp1, yp2)
+                answer_dict.update(answer_dict_)
+    metrics = evaluate(eval_file, answer_dict)
+    metrics["ms_per_batch"] = 1000. * seconds / max(len(batches), 1)
+    metrics["graph_bytes"] = graph_def.ByteSize()
+    return metrics
+
+
+# Export
+# ----------------------------------------------------------------------------------------- #
+def export(config):
+    if config.quantize not in QUANTIZE_MODES:
+        raise ValueError("quantize must be one of {}".format(", ".join(QUANTIZE_MODES)))
+    word_mat = load_embedding(config.word_emb_file)
+    print("Freezing model...")
+    graph_def, names = freeze(config, word_mat)
+
+    report = None
+    if config.quantize != "none":
+        print("Quantizing model ({})...".format(config.quantize))
+        batches = []
+        calibrate = None
+        if config.quant_calib_batches > 0:
+            eval_file = EvalStore(config.dev_eval_file)
+            batches = load_dev_batches(config, config.quant_calib_batches)
+            calibrate = lambda logged, logged_names: evaluate_frozen(logged, logged_names, word_mat, batches, eval_file)
+        quantized = quantize(graph_def, names, config.quantize, calibrate)
+        if batches:
+            report = {"float32": evaluate_frozen(graph_def, names, word_mat, batches, eval_file),
+                      config.quantize: evaluate_frozen(quantized, names, word_mat, batches, eval_file)}
+            for key in ("exact_match", "f1", "ms_per_batch", "graph_bytes"):
+                report["delta_" + key] = report[config.quantize][key] - report["float32"][key]
+        graph_def = quantized
+
+    save_frozen_graph(graph_def, names, config.frozen_graph_file)
+    print("Exported {} nodes to {}".format(len(graph_def.node), config.frozen_graph_file))
+    if report is not None:
+        with open(config.frozen_graph_file + ".report.json", "w") as fh:
+            json.dump(report, fh, indent=2)
+        print("float32: EM {:.2f}, F1 {:.2f}, {:.1f} ms/batch | {}: EM {:.2f}, F1 {:.2f}, {:.1f} ms/batch".format(
+            report["float32"]["exact_match"], report["float32"]["f1"], report["float32"]["ms_per_batch"], config.quantize,
+            report[config.quantize]["exact_match"], report[config.quantize]["f1"], report[config.quantize]["ms_per_batch"]))
+
+
+# Frozen Model
+# ----------------------------------------------------------------------------------------- #
+class FrozenModel(object):
+    """Inference-only model imported from a frozen graph, without model.py or layers.py.
+
+    It exposes the same tensors as a demo Model (c, q, c_enc, yp1, yp2, yp_score and the top-k spans), so it can be used
+    by engine.run_batch and BatchInferenceEngine.
+    """
+    def __init__(self, graph_def, names, word_mat=None, graph=None):
+        self.graph = graph if graph is not None else tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.c = self.graph.get_tensor_by_name(names["context"])
+        self.q = self.graph.get_tensor_by_name(names["question"])
+        self.yp1 = self.graph.get_tensor_by_name(names["yp1"])
+        self.yp2 = self.graph.get_tensor_by_name(names["yp2"])
+        self.yp_score = self.graph.get_tensor_by_name(names["yp_score"])
+        self.yp_starts = self.graph.get_tensor_by_name(names["yp_starts"])
+        self.yp_ends = self.graph.get_tensor_by_name(names["yp_ends"])
+        self.yp_probs = self.graph.get_tensor_by_name(names["yp_probs"])
+        # graphs frozen before the context encoding was exported cannot feed it
+        self.c_enc = self.graph.get_tensor_by_name(names["context_encoding"]) if "context_encoding" in names else None
+        self.word_mat_value = word_mat
+        self.word_mat_init = None
+        if names["word_mat_init"] is not None:
+            self.word_mat_init = self.graph.get_operation_by_name(names["word_mat_init"])
+            self.word_mat_ph = self.graph.get_tensor_by_name(names["word_mat_value"])
+
+    def init_word_mat(self, sess):
+        if self.word_mat_init is not None:
+            sess.run(self.word_mat_init, feed_dict={self.word_mat_ph: self.word_mat_value})
+
+
+def load_inference_model(config, word_mat):
+    # input: config: flags, use_frozen_graph selects the exported graph over the latest checkpoint,
+    #        word_mat: the embedding matrix from util.load_embedding
+    # output: a session and a model ready for engine.run_batch
+    graph = tf.Graph()
+    if config.use_frozen_graph:
+        graph_def, names = load_frozen_graph(config.frozen_graph_file)
+        model = FrozenModel(graph_def, names, word_mat=word_mat, graph=graph)
+    else:
+        from model import Model
+        model = Model(config, word_mat=word_mat, trainable=False, opt=False, demo=True, graph=graph)
+    with graph.as_default():
+        sess_config = tf.ConfigProto(allow_soft_placement=True)
+        sess_config.gpu_options.allow_growth = True
+        sess = tf.Session(config=sess_config)
+        sess.run(tf.global_variables_initializer())
+        model.init_word_mat(sess)
+        if not config.use_frozen_graph:
+            saver = tf.train.Saver()
+            saver.restore(sess, tf.train.latest_checkpoint(config.save_dir))
+            if config.decay < 1.0:
+                sess.run(model.assign_vars)
+    return sess, model
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import json as json
+from tqdm import tqdm
+from itertools import islice
+from multiprocessing import Pool
+
+from engine import run_batch, merge_windows
+from export import load_inference_model
+from preprocess import word_tokenize, split_windows, lookup_ids
+from util import load_embedding
+
+
+_word_dict = None
+
+
+def _init_tokenize_worker(word_dict):
+    global _word_dict
+    _word_dict = word_dict
+
+
+def _tokenize(line):
+    # input: line: one JSONL record with "context" and "question"
+    # output: (record, context ids, context tokens, question ids), ids are None if the record is malformed
+    try:
+        record = json.loads(line)
+        seg_c = word_tokenize(record["context"])
+        seg_q = word_tokenize(record["question"])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return {"raw": line.strip()}, None, None, None
+    c = lookup_ids(seg_c, _word_dict)
+    q = lookup_ids(seg_q, _word_dict)
+    return record, c, seg_c, q
+
+
+def _predict_chunk(sess, model, config, items):
+    # input: items: tokenized records of one chunk, in input order
+    # output: the best (start, end, prob) span per record, None for malformed or empty ones
+    tasks = []
+    for i, (_, c, _, q) in enumerate(items):
+        if c is None or len(c) == 0 or len(q) == 0:
+            continue
+        windows = split_windows(len(c), config.doc_window, config.doc_stride)
+        tasks.extend((i, windows, w, start, end) for w, (start, end) in enumerate(windows))
+    # run_batch only runs windows and questions of the same lengths together, sort them so that batches split little
+    tasks.sort(key=lambda task: (task[4] - task[3], len(items[task[0]][3])))
+    spans = [None] * len(items)
+    for b in range(0, len(tasks), config.batch_size):
+        batch = tasks[b: b + config.batch_size]
+        batch_spans = run_batch(sess, model, [items[i][1][start: end] for i, _, _, start, end in batch],
+                                [items[i][3] for i, _, _, _, _ in batch])
+        for (i, windows, w, _, _), span in zip(batch, batch_spans):
+            if spans[i] is None:
+                spans[i] = [None] * len(windows)
+            spans[i][w] = span
+    results = []
+    for (_, c, _, q), window_spans in zip(items, spans):
+        if window_spans is None:
+            results.append(None)
+        else:
+            results.append(merge_windows(split_windows(len(c), config.doc_window, config.doc_stride), window_spans)[0])
+    return results
+
+
+def infer(config):
+    word_mat = load_embedding(config.word_emb_file)
+    with open(config.word_dictionary, "r") as fh:
+        word_dict = json.load(fh)
+
+    # the next chunk is tokenized by the pool while the current one runs through the graph,
+    # only two chunks are held in memory at any time; the pool is forked before the session exists
+    pool = Pool(config.infer_workers, initializer=_init_tokenize_worker, initargs=(word_dict,))
+
+    print("Loading model...")
+    sess, model = load_inference_model(config, word_mat)
+    total = 0
+    with open(config.infer_file, "r", encoding="utf-8") as fin, \
+            open(config.infer_out_file, "w", encoding="utf-8") as fout:
+        lines = list(islice(fin, config.infer_chunk_size))
+        pending = pool.map_async(_tokenize, lines, chunksize=64) if lines else None
+        progress = tqdm()
+        while pending is not None:
+            items = pending.get()
+            lines = list(islice(fin, config.infer_chunk_size))
+            pending = pool.map_async(_tokenize, lines, chunksize=64) if lines else None
+            for (record, _, seg_c, _), span in zip(items, _predict_chunk(sess, model, config, items)):
+                out = {key: value for key, value in record.items() if key not in ("context", "question")}
+                out["answer"] = ''.join(seg_c[span[0]: span[1] + 1]) if span is not None else None
+                fout.write(json.dumps(out, ensure_ascii=False) + "\n")
+            fout.flush()
+            total += len(items)
+            progress.update(len(items))
+        progress.close()
+    pool.close()
+    pool.join()
+    sess.close()
+    print("Wrote {} answers to {}".format(total, config.infer_out_file))
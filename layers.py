@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import math
+import weakref
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops import nn_ops
 
@@ -27,7 +29,17 @@ def layer_norm_compute_python(x, epsilon, scale, bias):
     return norm_x * scale + bias
 
 
-def layer_norm(x, filters=None, epsilon=1e-6, scope=None, reuse=None):
+def layer_norm_compute_fused(x, epsilon, scale, bias):
+    """Layer norm with tf.nn.moments and tf.nn.batch_normalization.
+
+    The scale is folded into rsqrt(variance) on the [..., 1] statistics, so only two
+    elementwise ops run over the whole tensor instead of four.
+    """
+    mean, variance = tf.nn.moments(x, axes=[-1], keep_dims=True)
+    return tf.nn.batch_normalization(x, mean, variance, bias, scale, epsilon)
+
+
+def layer_norm(x, filters=None, epsilon=1e-6, scope=None, reuse=None, fused=True):
     """Layer normalize the tensor x, averaging over the last dimension."""
     if filters is None:
         filters = x.get_shape()[-1]
@@ -36,7 +48,10 @@ def layer_norm(x, filters=None, epsilon=1e-6, scope=None, reuse=None):
             "layer_norm_scale", [filters], regularizer = regularizer, initializer=tf.ones_initializer())
         bias = tf.get_variable(
             "layer_norm_bias", [filters], regularizer = regularizer, initializer=tf.zeros_initializer())
-        result = layer_norm_compute_python(x, epsilon, scale, bias)
+        if fused:
+            result = layer_norm_compute_fused(x, epsilon, scale, bias)
+        else:
+            result = layer_norm_compute_python(x, epsilon, scale, bias)
         return result
 
 
@@ -87,6 +102,8 @@ def highway(x, size=None, activation=None, num_layers=2, scope="highway", dropou
 
 
 def layer_dropout(inputs, residual, dropout):
+    if isinstance(dropout, float) and dropout == 0.0:
+        return inputs + residual
     pred = tf.random_uniform([]) < dropout
     return tf.cond(pred, lambda: residual, lambda: tf.nn.dropout(inputs, 1.0 - dropout) + residual)
 
@@ -150,8 +167,8 @@ def dot_product_attention(q, k, v, bias, mask=None, scope=None, reuse=None, drop
             b = tf.get_variable("bias", logits.shape[-1], regularizer=regularizer, initializer=tf.zeros_initializer())
             logits += b
         if mask is not None:
-            shapes = [x if x != None else -1 for x in logits.shape.as_list()]
-            mask = tf.reshape(mask, [shapes[0], 1, 1, shapes[-1]])
+            # [batch, length] -> [batch, 1, 1, length], batch and length may both be dynamic
+            mask = tf.expand_dims(tf.expand_dims(mask, 1), 1)
             logits = mask_logits(logits, mask)
         weights = tf.nn.softmax(logits, name="attention_weights")
         # dropping out the attention links for each of the heads
@@ -159,6 +176,71 @@ def dot_product_attention(q, k, v, bias, mask=None, scope=None, reuse=None, drop
         return tf.matmul(weights, v)
 
 
+def local_dot_product_attention(q, k, v, block_size, mask=None, num_global=0, scope=None, reuse=None, dropout=0.0):
+    # block-local dot-product attention
+    # input: q, k, v: Tensors with shape [batch, heads, length, depth] as in dot_product_attention,
+    #        block_size: the sequence is cut into blocks of block_size tokens and every query attends to
+    #                    the keys of its own block and of the two neighbouring blocks,
+    #        mask: a [batch, length] Tensor of valid positions,
+    #        num_global: the first num_global positions attend to, and are attended by, every position
+    # output: A Tensor [batch, heads, length, depth_v].
+    # Memory and time grow with length * 3 * block_size instead of length * length.
+    with tf.variable_scope(scope, default_name="local_dot_product_attention", reuse=reuse):
+        batch, heads, length = tf.shape(q)[0], tf.shape(q)[1], tf.shape(q)[2]
+        depth_k, depth_v = q.shape[-1].value, v.shape[-1].value
+        num_blocks = (length + block_size - 1) // block_size
+        pad = num_blocks * block_size - length
+        if mask is None:
+            mask = tf.ones([batch, length])
+        mask = tf.cast(mask, tf.float32)
+
+        def to_blocks(x, depth):
+            # [batch, heads, length, depth] -> [batch, heads, num_blocks, block_size, depth]
+            x = tf.pad(x, [[0, 0], [0, 0], [0, pad], [0, 0]])
+            return tf.reshape(x, [batch, -1, num_blocks, block_size, depth])
+
+        def with_neighbours(x):
+            # [..., num_blocks, block_size, depth] -> [..., num_blocks, 3 * block_size, depth]
+            prev_blocks = tf.pad(x, [[0, 0], [0, 0], [1, 0], [0, 0], [0, 0]])[:, :, :-1]
+            next_blocks = tf.pad(x, [[0, 0], [0, 0], [0, 1], [0, 0], [0, 0]])[:, :, 1:]
+            return tf.concat([prev_blocks, x, next_blocks], axis=3)
+
+        q_blocks = to_blocks(q, depth_k)
+        k_local = with_neighbours(to_blocks(k, depth_k))
+        v_local = with_neighbours(to_blocks(v, depth_v))
+        key_mask = mask
+        if num_global:
+            # global keys are attended through their own logits below, do not count them twice
+            key_mask *= tf.to_float(tf.range(length) >= num_global)
+        # [batch, length] -> [batch, 1, num_blocks, 1, 3 * block_size], the padding is masked out
+        key_mask = with_neighbours(to_blocks(tf.expand_dims(tf.expand_dims(key_mask, 1), 3), 1))
+        key_mask = tf.transpose(key_mask, [0, 1, 2, 4, 3])
+        # [batch, heads, num_blocks, block_size, 3 * block_size]
+        logits = mask_logits(tf.matmul(q_blocks, k_local, transpose_b=True), key_mask)
+        if num_global:
+            k_global, v_global = k[:, :, :num_global], v[:, :, :num_global]
+            # [batch, heads, num_blocks * block_size, num_global] -> [batch, heads, num_blocks, block_size, num_global]
+            global_logits = tf.matmul(tf.reshape(q_blocks, [batch, heads, -1, depth_k]), k_global, transpose_b=True)
+            global_logits = tf.reshape(global_logits, [batch, heads, num_blocks, block_size, -1])
+            global_mask = tf.reshape(mask[:, :num_global], [batch, 1, 1, 1, -1])
+            logits = tf.concat([logits, mask_logits(global_logits, global_mask)], axis=-1)
+        weights = tf.nn.softmax(logits, name="attention_weights")
+        weights = tf.nn.dropout(weights, 1.0 - dropout)
+        outputs = tf.matmul(weights[..., :3 * block_size], v_local)
+        outputs = tf.reshape(outputs, [batch, heads, -1, depth_v])
+        if num_global:
+            global_weights = tf.reshape(weights[..., 3 * block_size:], [batch, heads, -1, tf.shape(k_global)[2]])
+            outputs += tf.matmul(global_weights, v_global)
+        outputs = outputs[:, :, :length]
+        if num_global:
+            # the global queries see the whole sequence
+            global_outputs = dot_product_attention(q[:, :, :num_global], k, v, bias=False, mask=mask,
+                                                   scope="global_attention", reuse=reuse, dropout=dropout)
+            outputs = tf.concat([global_outputs, outputs[:, :, num_global:]], axis=2)
+        outputs.set_shape([None, q.shape[1].value, None, depth_v])
+        return outputs
+
+
 def split_last_dimension(x, n):
     # Reshape x so that the last dimension becomes two dimensions.
     # input: x: a Tensor with shape [..., m]
@@ -185,7 +267,9 @@ def combine_last_two_dimensions(x):
 
 
 def multihead_attention(queries, units, num_heads, memory=None, scope="Multi_Head_Attention",
-                        reuse=None, mask=None, bias=True, dropout=0.0):
+                        reuse=None, mask=None, bias=True, dropout=0.0, attention_window=0, global_tokens=0):
+    # attention_window: 0 for full attention, otherwise the block size of local_dot_product_attention
+    #                   (self attention only), global_tokens: its number of global positions
     with tf.variable_scope(scope, reuse = reuse):
         # Self attention
         if memory is None:
@@ -197,20 +281,28 @@ def multihead_attention(queries, units, num_heads, memory=None, scope="Multi_Hea
 
         key_depth_per_head = units // num_heads
         Q *= key_depth_per_head**-0.5
-        x = dot_product_attention(Q, K, V, bias=bias, mask=mask, scope="dot_product_attention",
-                                  reuse=reuse, dropout=dropout)
+        if attention_window:
+            if bias:
+                raise ValueError("the memory bias of dot_product_attention needs full attention")
+            x = local_dot_product_attention(Q, K, V, attention_window, mask=mask, num_global=global_tokens,
+                                            scope="local_dot_product_attention", reuse=reuse, dropout=dropout)
+        else:
+            x = dot_product_attention(Q, K, V, bias=bias, mask=mask, scope="dot_product_attention",
+                                      reuse=reuse, dropout=dropout)
         return combine_last_two_dimensions(tf.transpose(x,[0,2,1,3]))
 
 
 def self_attention_block(inputs, num_filters, seq_len, mask=None, num_heads=8, scope="self_attention_ffn", reuse=None,
-                         is_training=True, bias=True, dropout=0.0, sublayers=(1, 1)):
+                         is_training=True, bias=True, dropout=0.0, sublayers=(1, 1), attention_window=0,
+                         global_tokens=0):
     with tf.variable_scope(scope, reuse = reuse):
         l, L = sublayers
         # Self attention
         outputs = norm_fn(inputs, scope = "layer_norm_1", reuse = reuse)
         outputs = tf.nn.dropout(outputs, 1.0 - dropout)
         outputs = multihead_attention(outputs, num_filters, num_heads=num_heads,
-                                      reuse=reuse, mask=mask, bias=bias, dropout=dropout)
+                                      reuse=reuse, mask=mask, bias=bias, dropout=dropout,
+                                      attention_window=attention_window, global_tokens=global_tokens)
         residual = layer_dropout(outputs, inputs, dropout * float(l) / L)
         l += 1
         # Feed-forward
@@ -243,12 +335,46 @@ def get_timing_signal_1d(length, channels, min_timescale=1.0, max_timescale=1.0e
     return signal
 
 
-def add_timing_signal_1d(x, min_timescale=1.0, max_timescale=1.0e4):
-    # input: x: a Tensor with shape [batch, length, channels]
+MAX_TIMING_LENGTH = 8192
+_timing_tables = weakref.WeakKeyDictionary()
+
+
+def timing_signal_table(max_length, channels, min_timescale=1.0, max_timescale=1.0e4):
+    # numpy version of get_timing_signal_1d
+    # output: a float32 array [max_length, channels]
+    position = np.arange(max_length, dtype=np.float32)
+    num_timescales = channels // 2
+    log_timescale_increment = math.log(float(max_timescale) / float(min_timescale)) / (num_timescales - 1)
+    inv_timescales = min_timescale * np.exp(np.arange(num_timescales, dtype=np.float32) * -log_timescale_increment)
+    scaled_time = np.expand_dims(position, 1) * np.expand_dims(inv_timescales.astype(np.float32), 0)
+    signal = np.concatenate([np.sin(scaled_time), np.cos(scaled_time)], axis=1)
+    signal = np.pad(signal, [[0, 0], [0, channels % 2]], mode="constant")
+    return signal.astype(np.float32)
+
+
+def get_cached_timing_signal(channels, min_timescale=1.0, max_timescale=1.0e4):
+    # output: a [MAX_TIMING_LENGTH, channels] constant, created once per graph and shared by every block
+    graph = tf.get_default_graph()
+    tables = _timing_tables.setdefault(graph, {})
+    key = (channels, min_timescale, max_timescale)
+    if key not in tables:
+        # outside of any scope or control dependency of the block asking first
+        with graph.name_scope(None), graph.control_dependencies(None):
+            tables[key] = tf.constant(timing_signal_table(MAX_TIMING_LENGTH, channels, min_timescale, max_timescale),
+                                      name="timing_signal")
+    return tables[key]
+
+
+def add_timing_signal_1d(x, min_timescale=1.0, max_timescale=1.0e4, cached=True):
+    # input: x: a Tensor with shape [batch, length, channels], length <= MAX_TIMING_LENGTH if cached
     #        min_timescale: a float
     #        max_timescale: a float
+    #        cached: slice a precomputed table instead of computing sin/cos at every step
     # output: a Tensor the same shape as x.
     length = tf.shape(x)[1]
+    if cached and x.shape[-1].value is not None:
+        signal = get_cached_timing_signal(x.shape[-1].value, min_timescale, max_timescale)
+        return x + tf.expand_dims(signal[:length], 0)
     channels = tf.shape(x)[2]
     signal = get_timing_signal_1d(length, channels, min_timescale, max_timescale)
     return x + signal
@@ -256,7 +382,7 @@ def add_timing_signal_1d(x, min_timescale=1.0, max_timescale=1.0e4):
 
 def residual_block(inputs, num_blocks, num_conv_layers, kernel_size, mask = None, num_filters=128,
                    input_projection=False, num_heads=8, seq_len=None, scope="res_block",
-                   is_training=True, reuse=None, bias=True, dropout=0.0):
+                   is_training=True, reuse=None, bias=True, dropout=0.0, attention_window=0, global_tokens=0):
     with tf.variable_scope(scope, reuse=reuse):
         if input_projection:
             inputs = conv(inputs, num_filters, name="input_projection", reuse=reuse)
@@ -271,7 +397,8 @@ def residual_block(inputs, num_blocks, num_conv_layers, kernel_size, mask = None
             outputs, sublayer = self_attention_block(outputs, num_filters, seq_len, mask=mask, num_heads=num_heads,
                                                      scope="self_attention_layers%d"%i, reuse=reuse,
                                                      is_training=is_training, bias=bias, dropout=dropout,
-                                                     sublayers=(sublayer, total_sublayers))
+                                                     sublayers=(sublayer, total_sublayers),
+                                                     attention_window=attention_window, global_tokens=global_tokens)
         return outputs
 
 
@@ -388,6 +515,40 @@ def optimized_trilinear_for_attention(args, c_maxlen, q_maxlen, input_keep_prob=
         return res
 
 
+# Span Decoding
+# ----------------------------------------------------------------------------------------- #
+def outer_span_decode(logits1, logits2, top_k=1):
+    # input: logits1, logits2: masked start/end logits [batch, length],
+    #        top_k: number of spans returned
+    # output: starts, ends: int32 [batch, k], probs: float [batch, k], best span first.
+    #         Scores every start <= end pair through a [batch, length, length] outer product.
+    length = tf.shape(logits1)[1]
+    outer = tf.matmul(tf.expand_dims(tf.nn.softmax(logits1), axis=2), tf.expand_dims(tf.nn.softmax(logits2), axis=1))
+    outer = tf.matrix_band_part(outer, 0, -1)
+    flat = tf.reshape(outer, [tf.shape(outer)[0], -1])
+    probs, indices = tf.nn.top_k(flat, tf.minimum(top_k, tf.shape(flat)[1]))
+    return indices // length, indices % length, probs
+
+
+def banded_span_decode(logits1, logits2, max_len, top_k=1):
+    # input: logits1, logits2: masked start/end logits [batch, length],
+    #        max_len: max number of tokens between start and end,
+    #        top_k: number of spans returned
+    # output: starts, ends: int32 [batch, k], probs: float [batch, k], best span first.
+    #         Only the max_len + 1 ends following each start are scored: [batch, length, max_len + 1].
+    log_p1 = tf.nn.log_softmax(logits1)
+    log_p2 = tf.nn.log_softmax(logits2)
+    length = tf.shape(log_p1)[1]
+    width = max_len + 1
+    # ends past the context are padded with a probability of 0
+    padded_p2 = tf.pad(log_p2, [[0, 0], [0, max_len]], constant_values=-1e30)
+    scores = tf.stack([log_p1 + padded_p2[:, k: k + length] for k in range(width)], axis=2)
+    flat = tf.reshape(scores, [tf.shape(scores)[0], -1])
+    log_probs, indices = tf.nn.top_k(flat, tf.minimum(top_k, tf.shape(flat)[1]))
+    starts = indices // width
+    return starts, starts + indices % width, tf.exp(log_probs)
+
+
 # Total Parameters
 # ----------------------------------------------------------------------------------------- #
 def total_params():
@@ -1,32 +1,42 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import json as json
 from tqdm import tqdm
 import tensorflow as tf
 
 from model import Model
-from util import get_record_parser, convert_tokens, evaluate, get_batch_dataset, get_dataset
+from util import get_record_parser, convert_tokens, Evaluator, EvalStore, get_batch_dataset, get_dataset, load_embedding, \
+    get_bucket_boundaries, BucketStats, argv_without_mode
 
 
 def train(config):
-    with open(config.word_emb_file, "r") as fh:
-        word_mat = np.array(json.load(fh), dtype=np.float32)
-    with open(config.train_eval_file, "r") as fh:
-        train_eval_file = json.load(fh)
-    with open(config.dev_eval_file, "r") as fh:
-        dev_eval_file = json.load(fh)
-    with open(config.dev_meta, "r") as fh:
-        meta = json.load(fh)
-    dev_total = meta["total"]
+    word_mat = load_embedding(config.word_emb_file)
+    if not config.async_eval:
+        train_evaluator = Evaluator(EvalStore(config.train_eval_file), config.eval_workers)
+        dev_evaluator = Evaluator(EvalStore(config.dev_eval_file), config.eval_workers)
+        with open(config.dev_meta, "r") as fh:
+            meta = json.load(fh)
+        dev_total = meta["total"]
+    bucket_boundaries = None
+    if config.is_bucket and os.path.exists(config.train_meta):
+        with open(config.train_meta, "r") as fh:
+            train_meta = json.load(fh)
+        if "context_len_hist" in train_meta:
+            bucket_boundaries = get_bucket_boundaries(train_meta["context_len_hist"], config.num_buckets)
+            print("Bucket boundaries: {}".format(bucket_boundaries))
 
     print("Building model...")
     parser = get_record_parser(config)
     graph = tf.Graph()
     with graph.as_default() as g:
-        train_dataset = get_batch_dataset(config.train_record_file, parser, config)
-        dev_dataset = get_dataset(config.dev_record_file, parser, config)
+        train_dataset = get_batch_dataset(config.train_record_file, parser, config, bucket_boundaries)
+        dev_dataset = get_dataset(config.dev_record_file, config, cache=config.cache_dev)
         handle = tf.placeholder(tf.string, shape=[])
         iterator = tf.data.Iterator.from_string_handle(handle, train_dataset.output_types, train_dataset.output_shapes)
         train_iterator = train_dataset.make_one_shot_iterator()
@@ -42,56 +52,201 @@ def train(config):
         with tf.Session(config=sess_config) as sess:
             writer = tf.summary.FileWriter(config.log_dir)
             sess.run(tf.global_variables_initializer())
+            model.init_word_mat(sess)
+            if model.accum_init is not None:
+                sess.run(model.accum_init)
             saver = tf.train.Saver()
             train_handle = sess.run(train_iterator.string_handle())
             dev_handle = sess.run(dev_iterator.string_handle())
             if os.path.exists(os.path.join(config.save_dir, "checkpoint")):
                 saver.restore(sess, tf.train.latest_checkpoint(config.save_dir))
             global_step = max(sess.run(model.global_step), 1)
+            bucket_stats = BucketStats(bucket_boundaries)
+            eval_process = None
+            if config.async_eval:
+                if os.path.exists(_train_done_file(config)):
+                    os.remove(_train_done_file(config))
+                # a stop request left by the evaluator of an earlier run must not end this one
+                state = read_eval_state(config)
+                if state.get("stop", False):
+                    state["stop"] = False
+                    write_eval_state(config, state)
+                if config.spawn_evaluator:
+                    # the evaluator gets the same flags, only the mode differs
+                    eval_process = subprocess.Popen([sys.executable, sys.argv[0]] + argv_without_mode() + ["--mode=evaluate"])
 
             for _ in tqdm(range(global_step, config.num_steps + 1)):
                 global_step = sess.run(model.global_step) + 1
-                loss, train_op = sess.run([model.loss, model.train_op],
-                                          feed_dict={handle: train_handle, model.dropout: config.dropout})
+                # with --accum_steps K, one step is K micro-batches and one update
+                for _ in range(model.accum_steps - 1):
+                    step_start = time.time()
+                    _, c_len = sess.run([model.accum_op, model.c_len],
+                                        feed_dict={handle: train_handle, model.dropout: config.dropout})
+                    bucket_stats.update(c_len.tolist(), time.time() - step_start)
+                step_start = time.time()
+                loss, train_op, c_len = sess.run([model.loss, model.train_op, model.c_len],
+                                                 feed_dict={handle: train_handle, model.dropout: config.dropout})
+                bucket_stats.update(c_len.tolist(), time.time() - step_start)
                 if global_step % config.period == 0:
                     loss_sum = tf.Summary(value=[tf.Summary.Value(tag="model/loss", simple_value=loss), ])
                     writer.add_summary(loss_sum, global_step)
                 if global_step % config.checkpoint == 0:
-                    metrics, summ = evaluate_batch(model, config.val_num_batches, train_eval_file, sess, "train", handle, train_handle)
-                    for s in summ:
-                        writer.add_summary(s, global_step)
-
-                    metrics, summ = evaluate_batch(model, dev_total // config.batch_size + 1, dev_eval_file, sess, "dev", handle, dev_handle)
-
-                    dev_f1 = metrics["f1"]
-                    dev_em = metrics["exact_match"]
-                    if dev_f1 < best_f1 and dev_em < best_em:
-                        patience += 1
-                        if patience > config.early_stop:
-                            break
-                    else:
-                        patience = 0
-                        best_em = max(best_em, dev_em)
-                        best_f1 = max(best_f1, dev_f1)
-
-                    for s in summ:
-                        writer.add_summary(s, global_step)
+                    lines, bucket_sum = bucket_stats.report()
+                    for line in lines:
+                        print(line)
+                    writer.add_summary(bucket_sum, global_step)
+                    if not config.async_eval:
+                        metrics, summ = evaluate_batch(model, config.val_num_batches, train_evaluator, sess, "train", handle, train_handle)
+                        for s in summ:
+                            writer.add_summary(s, global_step)
+
+                        metrics, summ = evaluate_batch(model, dev_total // config.batch_size + 1, dev_evaluator, sess, "dev", handle, dev_handle)
+
+                        dev_f1 = metrics["f1"]
+                        dev_em = metrics["exact_match"]
+                        if dev_f1 < best_f1 and dev_em < best_em:
+                            patience += 1
+                            if patience > config.early_stop:
+                                break
+                        else:
+                            patience = 0
+                            best_em = max(best_em, dev_em)
+                            best_f1 = max(best_f1, dev_f1)
+
+                        for s in summ:
+                            writer.add_summary(s, global_step)
                     writer.flush()
                     filename = os.path.join(config.save_dir, "model_{}.ckpt".format(global_step))
                     saver.save(sess, filename)
+                    # the evaluator scores the checkpoints behind, it asks to stop through its state file
+                    if config.async_eval and read_eval_state(config).get("stop", False):
+                        print("Early stop requested by the evaluator at step {}".format(global_step))
+                        break
+
+            if config.async_eval:
+                open(_train_done_file(config), "w").close()
+                if eval_process is not None:
+                    eval_process.wait()
+            else:
+                train_evaluator.close()
+                dev_evaluator.close()
+
+
+def _eval_state_file(config):
+    return os.path.join(config.save_dir, "eval_state.json")
+
+
+def _train_done_file(config):
+    return os.path.join(config.save_dir, "train_done")
+
+
+def read_eval_state(config):
+    # output: the early stopping state written by evaluate_checkpoints, {} before its first checkpoint
+    if not os.path.exists(_eval_state_file(config)):
+        return {}
+    with open(_eval_state_file(config), "r") as fh:
+        return json.load(fh)
+
+
+def write_eval_state(config, state):
+    # write then rename, so that the training process never reads half a file
+    tmp_file = _eval_state_file(config) + ".tmp"
+    with open(tmp_file, "w") as fh:
+        json.dump(state, fh)
+    os.replace(tmp_file, _eval_state_file(config))
+
+
+def evaluate_checkpoints(config):
+    # score every new checkpoint of save_dir on val_num_batches train batches and the dev set, like the
+    # in-loop evaluation of train, while training goes on in another process (--async_eval)
+    word_mat = load_embedding(config.word_emb_file)
+    train_evaluator = Evaluator(EvalStore(config.train_eval_file), config.eval_workers)
+    dev_evaluator = Evaluator(EvalStore(config.dev_eval_file), config.eval_workers)
+    with open(config.dev_meta, "r") as fh:
+        meta = json.load(fh)
+    dev_total = meta["total"]
+
+    parser = get_record_parser(config)
+    graph = tf.Graph()
+    with graph.as_default() as g:
+        train_dataset = get_batch_dataset(config.train_record_file, parser, config)
+        dev_dataset = get_dataset(config.dev_record_file, config, cache=config.cache_dev)
+        handle = tf.placeholder(tf.string, shape=[])
+        iterator = tf.data.Iterator.from_string_handle(handle, train_dataset.output_types, train_dataset.output_shapes)
+        train_iterator = train_dataset.make_one_shot_iterator()
+        dev_iterator = dev_dataset.make_one_shot_iterator()
+
+        model = Model(config, iterator, word_mat, trainable=False, graph=g)
+        sess_config = tf.ConfigProto(allow_soft_placement=True)
+        sess_config.gpu_options.allow_growth = True
+
+        # resume the early stopping state of a previous evaluator, but never a stale stop request
+        state = {"global_step": 0, "best_f1": 0., "best_em": 0., "patience": 0}
+        state.update(read_eval_state(config))
+        state["stop"] = False
+        write_eval_state(config, state)
+        with tf.Session(config=sess_config) as sess:
+            writer = tf.summary.FileWriter(os.path.join(config.log_dir, "eval"))
+            sess.run(tf.global_variables_initializer())
+            model.init_word_mat(sess)
+            saver = tf.train.Saver()
+            train_handle = sess.run(train_iterator.string_handle())
+            dev_handle = sess.run(dev_iterator.string_handle())
+            # wait for new checkpoints until train marks itself done
+            for checkpoint in tf.contrib.training.checkpoints_iterator(
+                    config.save_dir, timeout=config.eval_poll_secs,
+                    timeout_fn=lambda: os.path.exists(_train_done_file(config))):
+                try:
+                    saver.restore(sess, checkpoint)
+                except tf.errors.NotFoundError:
+                    # removed by the saver of train before we got to it
+                    continue
+                global_step = sess.run(model.global_step)
+                if global_step <= state["global_step"]:
+                    continue
+                metrics, summ = evaluate_batch(model, config.val_num_batches, train_evaluator, sess, "train", handle, train_handle)
+                for s in summ:
+                    writer.add_summary(s, global_step)
+                metrics, summ = evaluate_batch(model, dev_total // config.batch_size + 1, dev_evaluator, sess, "dev", handle, dev_handle)
+                for s in summ:
+                    writer.add_summary(s, global_step)
+                writer.flush()
+
+                dev_f1 = metrics["f1"]
+                dev_em = metrics["exact_match"]
+                if dev_f1 < state["best_f1"] and dev_em < state["best_em"]:
+                    state["patience"] += 1
+                    state["stop"] = state["patience"] > config.early_stop
+                else:
+                    state["patience"] = 0
+                    state["best_em"] = max(state["best_em"], dev_em)
+                    state["best_f1"] = max(state["best_f1"], dev_f1)
+                state["global_step"] = int(global_step)
+                write_eval_state(config, state)
+                print("Step {}: dev EM {:.3f}, F1 {:.3f}".format(global_step, dev_em, dev_f1))
+                if state["stop"] or global_step >= config.num_steps:
+                    break
+            writer.close()
+    train_evaluator.close()
+    dev_evaluator.close()
 
 
-def evaluate_batch(model, num_batches, eval_file, sess, data_type, handle, str_handle):
+def evaluate_batch(model, num_batches, evaluator, sess, data_type, handle, str_handle):
     answer_dict = {}
     losses = []
-    for _ in tqdm(range(1, num_batches + 1)):
-        qa_id, loss, yp1, yp2, = sess.run([model.qa_id, model.loss, model.yp1, model.yp2],
-                                          feed_dict={handle: str_handle})
-        answer_dict_, _ = convert_tokens(eval_file, qa_id.tolist(), yp1.tolist(), yp2.tolist())
-        answer_dict.update(answer_dict_)
-        losses.append(loss)
+    # spans are converted to text on a background thread while the next batch runs
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = []
+        for _ in tqdm(range(1, num_batches + 1)):
+            qa_id, loss, yp1, yp2, = sess.run([model.qa_id, model.loss, model.yp1, model.yp2],
+                                              feed_dict={handle: str_handle})
+            futures.append(executor.submit(convert_tokens, evaluator.eval_file, qa_id, yp1, yp2))
+            losses.append(loss)
+        for future in futures:
+            answer_dict_, _ = future.result()
+            answer_dict.update(answer_dict_)
     loss = np.mean(losses)
-    metrics = evaluate(eval_file, answer_dict)
+    metrics = evaluator.evaluate(answer_dict)
     metrics["loss"] = loss
     loss_sum = tf.Summary(value=[tf.Summary.Value(tag="{}/loss".format(data_type), simple_value=metrics["loss"]), ])
     f1_sum = tf.Summary(value=[tf.Summary.Value(tag="{}/f1".format(data_type), simple_value=metrics["f1"]), ])
@@ -100,10 +255,10 @@ def evaluate_batch(model, num_batches, eval_file, sess, data_type, handle, str_h
 
 
 def test(config):
-    with open(config.word_emb_file, "r") as fh:
-        word_mat = np.array(json.load(fh), dtype=np.float32)
-    with open(config.test_eval_file, "r") as fh:
-        eval_file = json.load(fh)
+    word_mat = load_embedding(config.word_emb_file)
+    eval_file = EvalStore(config.test_eval_file)
+    # the scoring processes are forked before any session exists
+    evaluator = Evaluator(eval_file, config.eval_workers)
     with open(config.test_meta, "r") as fh:
         meta = json.load(fh)
     total = meta["total"]
@@ -111,7 +266,7 @@ def test(config):
     print("Loading model...")
     graph = tf.Graph()
     with graph.as_default() as g:
-        test_batch = get_dataset(config.test_record_file, get_record_parser(config, is_test=True), config).make_one_shot_iterator()
+        test_batch = get_dataset(config.test_record_file, config).make_one_shot_iterator()
 
         model = Model(config, test_batch, word_mat, trainable=False, graph=g)
         sess_config = tf.ConfigProto(allow_soft_placement=True)
@@ -119,6 +274,7 @@ def test(config):
 
         with tf.Session(config=sess_config) as sess:
             sess.run(tf.global_variables_initializer())
+            model.init_word_mat(sess)
             saver = tf.train.Saver()
             saver.restore(sess, tf.train.latest_checkpoint(config.save_dir))
             if config.decay < 1.0:
@@ -126,13 +282,18 @@ def test(config):
             losses = []
             answer_dict = {}
             remapped_dict = {}
-            for _ in tqdm(range(total // config.batch_size + 1)):
-                qa_id, loss, yp1, yp2, logits = sess.run([model.qa_id, model.loss, model.yp1, model.yp2, model.logits])
-                answer_dict_, remapped_dict_ = convert_tokens(eval_file, qa_id.tolist(), yp1.tolist(), yp2.tolist())
-                answer_dict.update(answer_dict_)
-                remapped_dict.update(remapped_dict_)
-                losses.append(loss)
-            metrics = evaluate(eval_file, answer_dict)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                futures = []
+                for _ in tqdm(range(total // config.batch_size + 1)):
+                    qa_id, loss, yp1, yp2 = sess.run([model.qa_id, model.loss, model.yp1, model.yp2])
+                    futures.append(executor.submit(convert_tokens, eval_file, qa_id, yp1, yp2))
+                    losses.append(loss)
+                for future in futures:
+                    answer_dict_, remapped_dict_ = future.result()
+                    answer_dict.update(answer_dict_)
+                    remapped_dict.update(remapped_dict_)
+            metrics = evaluator.evaluate(answer_dict)
+            evaluator.close()
             with open(config.answer_file, "w") as fh:
                 json.dump(remapped_dict, fh, ensure_ascii=False)
             print("Exact Match: {}, F1: {}".format(
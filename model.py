@@ -1,51 +1,62 @@
 # -*- coding: utf-8 -*-
 
 import tensorflow as tf
-from layers import initializer, regularizer, highway, conv, residual_block, mask_logits, optimized_trilinear_for_attention, total_params
+from layers import initializer, regularizer, highway, conv, residual_block, mask_logits, optimized_trilinear_for_attention, total_params, \
+    outer_span_decode, banded_span_decode
 
 
 class Model(object):
-    def __init__(self, config, batch=None, word_mat=None, trainable=True, opt=True, demo=False, graph=None):
+    def __init__(self, config, batch=None, word_mat=None, trainable=True, opt=True, demo=False, graph=None,
+                 optimizer_fn=None):
+        # optimizer_fn: optional (optimizer, var_ema) -> optimizer wrapping Adam, e.g. distributed.sync_optimizer;
+        #               the wrapper receives unclipped gradients and applies the clipping and the EMA itself
         self.config = config
         self.demo = demo
+        self.optimizer_fn = optimizer_fn
+        # micro-batches summed per update, see config.accum_steps
+        self.accum_steps = config.accum_steps if trainable and optimizer_fn is None else 1
+        self.accum_op = self.accum_init = None
         self.graph = graph if graph is not None else tf.Graph()
         with self.graph.as_default():
-            y1 = [[0, 0]]
-            y2 = [[0, 0]]
             self.global_step = tf.get_variable('global_step', shape=[], dtype=tf.int32, initializer=tf.constant_initializer(0), trainable=False)
-            self.dropout = tf.placeholder_with_default(0.0, (), name="dropout")
+            # inference graphs get a python 0.0 so that no dropout op is built at all
+            self.dropout = tf.placeholder_with_default(0.0, (), name="dropout") if trainable else 0.0
             if self.demo:
-                self.c = tf.placeholder(tf.int32, [1, None], "context")
-                self.q = tf.placeholder(tf.int32, [1, None], "question")
-                self.y1 = y1
-                self.y2 = y2
-                self.qa_id = tf.cast(list(range(1)), tf.int32)
+                # batch size is left open so that the inference engine can stack concurrent requests
+                self.c = tf.placeholder(tf.int32, [None, None], "context")
+                self.q = tf.placeholder(tf.int32, [None, None], "question")
+                self.y1 = tf.zeros([tf.shape(self.c)[0]], dtype=tf.int32)
+                self.y2 = tf.zeros([tf.shape(self.c)[0]], dtype=tf.int32)
+                self.qa_id = tf.range(tf.shape(self.c)[0])
             else:
                 self.c, self.q, self.y1, self.y2, self.qa_id = batch.get_next()
 
-            self.word_mat = tf.constant(word_mat, dtype=tf.float32)
+            self.word_mat_value = word_mat
+            if config.word_mat_in_graph:
+                self.word_mat_init = None
+                self.word_mat = tf.constant(word_mat, dtype=tf.float32)
+            else:
+                # keep the table out of the GraphDef (and the checkpoints): a local variable fed once via init_word_mat
+                self.word_mat_ph = tf.placeholder(tf.float32, word_mat.shape, name="word_mat_value")
+                self.word_mat = tf.Variable(self.word_mat_ph, trainable=False, name="word_mat",
+                                            collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                self.word_mat_init = self.word_mat.initializer
 
             self.c_mask = tf.cast(self.c, tf.bool)
             self.q_mask = tf.cast(self.q, tf.bool)
             self.c_len = tf.reduce_sum(tf.cast(self.c_mask, tf.int32), axis=1)
             self.q_len = tf.reduce_sum(tf.cast(self.q_mask, tf.int32), axis=1)
             if opt:
-                N = config.batch_size if not self.demo else 1
                 self.c_maxlen = tf.reduce_max(self.c_len)
                 self.q_maxlen = tf.reduce_max(self.q_len)
-                self.c = tf.slice(self.c, [0, 0], [N, self.c_maxlen])
-                self.q = tf.slice(self.q, [0, 0], [N, self.q_maxlen])
-                self.c_mask = tf.slice(self.c_mask, [0, 0], [N, self.c_maxlen])
-                self.q_mask = tf.slice(self.q_mask, [0, 0], [N, self.q_maxlen])
-                self.y1 = tf.slice(self.y1, [0, 0], [N, self.c_maxlen])
-                self.y2 = tf.slice(self.y2, [0, 0], [N, self.c_maxlen])
+                self.c = tf.slice(self.c, [0, 0], [-1, self.c_maxlen])
+                self.q = tf.slice(self.q, [0, 0], [-1, self.q_maxlen])
+                self.c_mask = tf.slice(self.c_mask, [0, 0], [-1, self.c_maxlen])
+                self.q_mask = tf.slice(self.q_mask, [0, 0], [-1, self.q_maxlen])
             else:
-                if self.demo:
-                    self.c_maxlen = tf.reduce_max(self.c_len)
-                    self.q_maxlen = tf.reduce_max(self.q_len)
-                else:
-                    self.c_maxlen = config.para_limit
-                    self.q_maxlen = config.ques_limit
+                # inputs are padded to the longest context/question of the batch
+                self.c_maxlen = tf.shape(self.c)[1]
+                self.q_maxlen = tf.shape(self.q)[1]
 
             self.forward()
             total_params()
@@ -53,14 +64,45 @@ class Model(object):
             if trainable:
                 self.lr = tf.minimum(config.learning_rate, 0.001 / tf.log(999.) * tf.log(tf.cast(self.global_step, tf.float32) + 1))
                 self.opt = tf.train.AdamOptimizer(learning_rate = self.lr, beta1 = 0.8, beta2 = 0.999, epsilon = 1e-7)
-                grads = self.opt.compute_gradients(self.loss)
-                gradients, variables = zip(*grads)
-                capped_grads, _ = tf.clip_by_global_norm(gradients, config.grad_clip)
-                self.train_op = self.opt.apply_gradients(zip(capped_grads, variables), global_step=self.global_step)
+                if optimizer_fn is not None:
+                    self.opt = optimizer_fn(self.opt, self.var_ema if config.decay is not None else None)
+                    grads = self.opt.compute_gradients(self.loss)
+                    self.train_op = self.opt.apply_gradients(grads, global_step=self.global_step)
+                elif self.accum_steps > 1:
+                    self.build_accumulation()
+                else:
+                    grads = self.opt.compute_gradients(self.loss)
+                    gradients, variables = zip(*grads)
+                    capped_grads, _ = tf.clip_by_global_norm(gradients, config.grad_clip)
+                    self.train_op = self.opt.apply_gradients(zip(capped_grads, variables), global_step=self.global_step)
+
+    def build_accumulation(self):
+        # accum_op adds the capped gradients of one micro-batch to local accumulators,
+        # train_op adds the last micro-batch, applies the mean with one Adam step and one EMA step
+        # and clears the accumulators: global_step (and the warm-up) count effective steps
+        config = self.config
+        grads = [(g, v) for g, v in self.opt.compute_gradients(self.loss) if g is not None]
+        gradients, variables = zip(*grads)
+        capped_grads, _ = tf.clip_by_global_norm(gradients, config.grad_clip)
+        # local variables stay out of the checkpoints
+        accums = [tf.Variable(tf.zeros(var.shape, var.dtype.base_dtype), trainable=False,
+                              name="accum_{}".format(var.op.name.replace("/", "_")),
+                              collections=[tf.GraphKeys.LOCAL_VARIABLES]) for var in variables]
+        self.accum_init = tf.variables_initializer(accums)
+        self.accum_op = tf.group(*[tf.assign_add(accum, tf.convert_to_tensor(grad))
+                                   for accum, grad in zip(accums, capped_grads)])
+        with tf.control_dependencies([self.accum_op]):
+            mean_grads = [accum.read_value() / float(self.accum_steps) for accum in accums]
+        apply_op = self.opt.apply_gradients(zip(mean_grads, variables), global_step=self.global_step)
+        with tf.control_dependencies([apply_op]):
+            updates = [tf.assign(accum, tf.zeros_like(accum)) for accum in accums]
+            if config.decay is not None:
+                updates.append(self.var_ema.apply(tf.trainable_variables()))
+            self.train_op = tf.group(*updates)
 
     def forward(self):
         config = self.config
-        N, PL, QL, d, nh = config.batch_size if not self.demo else 1, self.c_maxlen, self.q_maxlen, config.hidden, config.num_heads
+        PL, QL, d, nh = self.c_maxlen, self.q_maxlen, config.hidden, config.num_heads
 
         with tf.variable_scope("Input_Embedding_Layer"):
             c_emb = tf.nn.dropout(tf.nn.embedding_lookup(self.word_mat, self.c), 1.0 - self.dropout)
@@ -79,7 +121,9 @@ class Model(object):
                                seq_len=self.c_len,
                                scope="Encoder_Residual_Block",
                                bias=False,
-                               dropout=self.dropout)
+                               dropout=self.dropout,
+                               attention_window=config.emb_attention_window,
+                               global_tokens=config.attention_global_tokens)
             q = residual_block(q_emb,
                                num_blocks=1,
                                num_conv_layers=4,
@@ -91,7 +135,15 @@ class Model(object):
                                scope="Encoder_Residual_Block",
                                reuse=True, # Share the weights between passage and question
                                bias=False,
-                               dropout=self.dropout)
+                               dropout=self.dropout)  # questions are short, they keep full attention
+
+        # the context encoding does not depend on the question: demo graphs accept it as an input
+        # (engine.ContextEncodingCache), and then skip the context embedding and encoder altogether
+        if self.demo:
+            self.c_enc = tf.placeholder_with_default(c, [None, None, d], name="context_encoding")
+        else:
+            self.c_enc = tf.identity(c, name="context_encoding")
+        c = self.c_enc
 
         with tf.variable_scope("Context_to_Query_Attention_Layer"):
             S = optimized_trilinear_for_attention([c, q], self.c_maxlen, self.q_maxlen, input_keep_prob = 1.0 - self.dropout)
@@ -120,7 +172,9 @@ class Model(object):
                                                scope="Model_Encoder",
                                                bias=False,
                                                reuse=True if i > 0 else None,
-                                               dropout=self.dropout))
+                                               dropout=self.dropout,
+                                               attention_window=config.model_attention_window,
+                                               global_tokens=config.attention_global_tokens))
 
         with tf.variable_scope("Output_Layer"):
             start_logits = tf.squeeze(conv(tf.concat([self.enc[1], self.enc[2]],axis=-1), 1, bias=False, name="start_pointer"), -1)
@@ -128,12 +182,24 @@ class Model(object):
             self.logits = [mask_logits(start_logits, mask=self.c_mask), mask_logits(end_logits, mask=self.c_mask)]
             logits1, logits2 = [l for l in self.logits]
 
-            outer = tf.matmul(tf.expand_dims(tf.nn.softmax(logits1), axis=2), tf.expand_dims(tf.nn.softmax(logits2), axis=1))
-            outer = tf.matrix_band_part(outer, 0, -1)
-            self.yp1 = tf.argmax(tf.reduce_max(outer, axis=2), axis=1)
-            self.yp2 = tf.argmax(tf.reduce_max(outer, axis=1), axis=1)
-            losses = tf.nn.softmax_cross_entropy_with_logits(logits=logits1, labels=self.y1)
-            losses2 = tf.nn.softmax_cross_entropy_with_logits(logits=logits2, labels=self.y2)
+            if config.span_decoder == "outer":
+                starts, ends, probs = outer_span_decode(logits1, logits2, top_k=config.top_k)
+            elif config.span_decoder == "banded":
+                # the test records keep answers up to test_ans_limit tokens
+                max_len = config.test_ans_limit if config.mode == "test" else config.ans_limit
+                starts, ends, probs = banded_span_decode(logits1, logits2, max_len, top_k=config.top_k)
+            else:
+                raise ValueError("Unknown span decoder {}".format(config.span_decoder))
+            # top-k spans [batch, k], best first
+            self.yp_starts = tf.identity(starts, name="yp_starts")
+            self.yp_ends = tf.identity(ends, name="yp_ends")
+            self.yp_probs = tf.identity(probs, name="yp_probs")
+            self.yp1 = tf.identity(starts[:, 0], name="yp1")
+            self.yp2 = tf.identity(ends[:, 0], name="yp2")
+            # probability of the best span, comparable across windows of a long context
+            self.yp_score = tf.identity(probs[:, 0], name="yp_score")
+            losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits1, labels=self.y1)
+            losses2 = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits2, labels=self.y2)
             self.loss = tf.reduce_mean(losses + losses2)
 
         if config.l2_norm is not None:
@@ -143,15 +209,21 @@ class Model(object):
 
         if config.decay is not None:
             self.var_ema = tf.train.ExponentialMovingAverage(config.decay)
-            ema_op = self.var_ema.apply(tf.trainable_variables())
-            with tf.control_dependencies([ema_op]):
-                self.loss = tf.identity(self.loss)
-
-                self.assign_vars = []
-                for var in tf.global_variables():
-                    v = self.var_ema.average(var)
-                    if v:
-                        self.assign_vars.append(tf.assign(var,v))
+            # with an optimizer_fn or gradient accumulation the EMA is applied once per update instead
+            if self.optimizer_fn is None and self.accum_steps == 1:
+                ema_op = self.var_ema.apply(tf.trainable_variables())
+                with tf.control_dependencies([ema_op]):
+                    self.loss = tf.identity(self.loss)
+
+                    self.assign_vars = []
+                    for var in tf.global_variables():
+                        v = self.var_ema.average(var)
+                        if v:
+                            self.assign_vars.append(tf.assign(var,v))
+
+    def init_word_mat(self, sess):
+        if self.word_mat_init is not None:
+            sess.run(self.word_mat_init, feed_dict={self.word_mat_ph: self.word_mat_value})
 
     def get_loss(self):
         return self.loss
@@ -1,46 +1,35 @@
 # -*- coding: utf-8 -*-
 
-import numpy as np
 import json as json
-import tensorflow as tf
 
 from config import flags
-from model import Model
-from preprocess import preprocess
+from engine import run_batch, merge_windows
+from export import load_inference_model
+from preprocess import preprocess, split_windows
+from util import load_embedding
 
 
 # Configuration
 #############################################################################################
 config = flags.FLAGS
-graph = tf.Graph()
-with open(config.word_emb_file, "r") as fh:
-    word_mat = np.array(json.load(fh), dtype=np.float32)
+word_mat = load_embedding(config.word_emb_file)
 with open(config.word_dictionary, "r") as fh:
     word_dict = json.load(fh)
 
-model = Model(config, word_mat=word_mat, trainable=False, opt=False, demo=True, graph=graph)
-
+sess, model = load_inference_model(config, word_mat)
 default_q = [[1, 2]]
 default_c = [[3, 4]]
-with graph.as_default() as g:
-    sess_config = tf.ConfigProto(allow_soft_placement=True)
-    sess_config.gpu_options.allow_growth = True
-    sess = tf.Session(config=sess_config)
-    sess.run(tf.global_variables_initializer())
-    saver = tf.train.Saver()
-    saver.restore(sess, tf.train.latest_checkpoint(config.save_dir))
-    if config.decay < 1.0:
-        sess.run(model.assign_vars)
-    qa_id, logits, yp1, yp2 = sess.run([model.qa_id, model.logits, model.yp1, model.yp2],
-                                       feed_dict={model.c:default_c, model.q:default_q})
+run_batch(sess, model, default_c, default_q)
 
 
 def readingComprehension(para, query):
     c, seg_c = preprocess(para, config, word_dict)
     q, _ = preprocess(query, config, word_dict)
-    qa_id, logits, yp1, yp2 = sess.run([model.qa_id, model.logits, model.yp1, model.yp2], 
-                                       feed_dict={model.c:c, model.q:q})
-    answer = ''.join(seg_c[yp1[0]: yp2[0]])
+    # long contexts are answered window by window in one batch
+    windows = split_windows(len(seg_c), config.doc_window, config.doc_stride)
+    spans = run_batch(sess, model, [c[0][start: end] for start, end in windows], [q[0]] * len(windows))
+    yp1, yp2, _ = merge_windows(windows, spans)[0]
+    answer = ''.join(seg_c[yp1: yp2 + 1])
     return answer
 
 
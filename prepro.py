@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import os
 import random
+import pickle
+import hashlib
 import numpy as np
 import json as json
 from tqdm import tqdm
 from codecs import open
 from collections import Counter
+from multiprocessing import Pool
 import tensorflow as tf
 import jieba
 
@@ -26,83 +30,211 @@ def convert_idx(text, tokens):
     return spans
 
 
-def process_file(filename, data_type, word_counter):
+def _process_articles(articles):
+    # input: articles: a slice of source["document"]
+    # output: examples, their eval examples in the same order and a partial word Counter,
+    #         ids are assigned when the slices are merged in process_file
+    word_counter = Counter()
+    examples, eval_examples = [], []
+    for article in articles:
+        for para in article["paragraphs"]:
+            context = para["context"]
+            context_tokens = para["segmented_context"]
+            spans = convert_idx(context, context_tokens)
+            if spans == None:
+                continue
+            for token in context_tokens:
+                word_counter[token] += len(para["qas"])
+            for qa in para["qas"]:
+                ques_tokens = qa["segmented_question"]
+                for token in ques_tokens:
+                    word_counter[token] += 1
+                y1s, y2s = [], []
+                answer_texts = []
+                for answer in qa["answers"]:
+                    answer_text = answer["text"]
+                    answer_texts.append(answer_text)
+                    try:
+                        y1, y2 = answer["answer_span"][0], answer["answer_span"][-1]
+                    except:
+                        continue
+                    y1s.append(y1)
+                    y2s.append(y2)
+                example = {"context_tokens": context_tokens, "ques_tokens": ques_tokens,
+                           "y1s": y1s, "y2s": y2s, "id": None}
+                examples.append(example)
+                eval_examples.append({"context": context, "spans": spans, "answers": answer_texts, "uuid": qa["id"]})
+    return examples, eval_examples, word_counter
+
+
+def process_file(filename, data_type, word_counter, num_workers=1):
     print("Generating {} examples...".format(data_type))
     examples = []
     eval_examples = {}
     total = 0
     with open(filename, "r") as fh:
-        source = json.load(fh)
-        for article in tqdm(source["document"]):
-            for para in article["paragraphs"]:
-                context = para["context"]
-                context_tokens = para["segmented_context"]
-                spans = convert_idx(context, context_tokens)
-                if spans == None:
-                    continue
-                for token in context_tokens:
-                    word_counter[token] += len(para["qas"])
-                for qa in para["qas"]:
-                    total += 1
-                    ques_tokens = qa["segmented_question"]
-                    for token in ques_tokens:
-                        word_counter[token] += 1
-                    y1s, y2s = [], []
-                    answer_texts = []
-                    for answer in qa["answers"]:
-                        answer_text = answer["text"]
-                        answer_texts.append(answer_text)
-                        try:
-                            y1, y2 = answer["answer_span"][0], answer["answer_span"][-1]
-                        except:
-                            continue
-                        y1s.append(y1)
-                        y2s.append(y2)
-                    example = {"context_tokens": context_tokens, "ques_tokens": ques_tokens,
-                               "y1s": y1s, "y2s": y2s, "id": total}
-                    examples.append(example)
-                    eval_examples[str(total)] = {"context": context, "spans": spans, "answers": answer_texts, "uuid": qa["id"]}
-        random.shuffle(examples)
-        print("{} questions in total".format(len(examples)))
+        articles = json.load(fh)["document"]
+    chunk_size = max(1, len(articles) // (max(1, num_workers) * 8))
+    chunks = [articles[i: i + chunk_size] for i in range(0, len(articles), chunk_size)]
+    if num_workers > 1:
+        pool = Pool(num_workers)
+        results = pool.imap(_process_articles, chunks)
+    else:
+        pool = None
+        results = map(_process_articles, chunks)
+    # slices come back in order, so ids match a sequential pass over the file
+    for chunk_examples, chunk_eval_examples, chunk_counter in tqdm(results, total=len(chunks)):
+        word_counter.update(chunk_counter)
+        for example, eval_example in zip(chunk_examples, chunk_eval_examples):
+            total += 1
+            example["id"] = total
+            examples.append(example)
+            eval_examples[str(total)] = eval_example
+    if pool is not None:
+        pool.close()
+        pool.join()
+    random.shuffle(examples)
+    print("{} questions in total".format(len(examples)))
     return examples, eval_examples
 
 
-def get_embedding(counter, data_type, limit=-1, emb_file=None, size=None, vec_size=None):
+def _split_file(filename, num_chunks):
+    # input: filename: a text file,
+    #        num_chunks: the number of byte ranges wanted
+    # output: a list of (start, end) byte offsets, each range starting at the beginning of a line
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, "rb") as fh:
+        for i in range(1, num_chunks):
+            fh.seek(max(size * i // num_chunks, offsets[-1]))
+            fh.readline()
+            offsets.append(min(fh.tell(), size))
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
+
+
+_emb_tokens = None
+_emb_vec_size = None
+
+
+def _init_embedding_worker(tokens, vec_size):
+    global _emb_tokens, _emb_vec_size
+    _emb_tokens = tokens
+    _emb_vec_size = vec_size
+
+
+def _read_embedding_range(args):
+    # input: args: (emb_file, start, end), a byte range produced by _split_file
+    # output: words found in the vocabulary and a float32 matrix of their vectors, in file order
+    filename, start, end = args
+    words, vectors = [], []
+    with open(filename, "rb") as fh:
+        fh.seek(start)
+        position = start
+        while position < end:
+            line = fh.readline()
+            if not line:
+                break
+            position += len(line)
+            array = line.rsplit(None, _emb_vec_size)
+            if len(array) != _emb_vec_size + 1:  # header or malformed line
+                continue
+            # look the token up first, the floats are only parsed for words in the vocabulary
+            word = "".join(array[0].decode("utf-8", errors="replace").split())
+            if word not in _emb_tokens:
+                continue
+            words.append(word)
+            vectors.append(list(map(float, array[1:])))
+    return words, np.array(vectors, dtype=np.float32).reshape([-1, _emb_vec_size])
+
+
+def _file_stamp(filename):
+    # a cheap fingerprint of a large source file: its path, size and modification time
+    stat = os.stat(filename)
+    return "{}|{}|{}".format(os.path.abspath(filename), stat.st_size, int(stat.st_mtime))
+
+
+def _embedding_cache_key(tokens, emb_file, vec_size):
+    sha = hashlib.sha1()
+    sha.update("{}|{}\n".format(_file_stamp(emb_file), vec_size).encode("utf-8"))
+    for token in sorted(tokens):
+        sha.update(token.encode("utf-8"))
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+
+def get_embedding(counter, data_type, limit=-1, emb_file=None, size=None, vec_size=None, num_workers=1, cache_dir=None):
     print("Generating {} embedding...".format(data_type))
-    embedding_dict = {}
+    NULL = "--NULL--"
+    OOV = "--OOV--"
     filtered_elements = [k for k, v in counter.items() if v > limit]
+    token2idx_dict = {NULL: 0, OOV: 1}
     if emb_file is not None:
         assert size is not None
         assert vec_size is not None
-        with open(emb_file, "r", encoding="utf-8") as fh:
-            for line in tqdm(fh, total=size):
-                array = line.split()
-                word = "".join(array[0:-vec_size])
-                vector = list(map(float, array[-vec_size:]))
-                if word in counter and counter[word] > limit:
-                    embedding_dict[word] = vector
-        print("{} / {} tokens have corresponding {} embedding vector".format(len(embedding_dict), len(filtered_elements), data_type))
+        cache_file = None
+        if cache_dir:
+            key = _embedding_cache_key(filtered_elements, emb_file, vec_size)
+            cache_file = os.path.join(cache_dir, "{}_emb_{}".format(data_type, key))
+            if os.path.exists(cache_file + ".npy") and os.path.exists(cache_file + ".json"):
+                print("Loading cached {} embedding from {}...".format(data_type, cache_file))
+                with open(cache_file + ".json", "r", encoding="utf-8") as fh:
+                    token2idx_dict = json.load(fh)
+                return np.load(cache_file + ".npy"), token2idx_dict
+        tokens = set(filtered_elements) - {NULL, OOV}
+        # rows 0 and 1 stay zero for --NULL-- and --OOV--, matched vectors are written in file order
+        emb_mat = np.zeros([len(tokens) + 2, vec_size], dtype=np.float32)
+        tasks = [(emb_file, start, end) for start, end in _split_file(emb_file, max(1, num_workers) * 16)]
+        if num_workers > 1:
+            pool = Pool(num_workers, initializer=_init_embedding_worker, initargs=(tokens, vec_size))
+            results = pool.imap(_read_embedding_range, tasks)
+        else:
+            pool = None
+            _init_embedding_worker(tokens, vec_size)
+            results = map(_read_embedding_range, tasks)
+        for words, vectors in tqdm(results, total=len(tasks)):
+            for word, vector in zip(words, vectors):
+                emb_mat[token2idx_dict.setdefault(word, len(token2idx_dict))] = vector
+        if pool is not None:
+            pool.close()
+            pool.join()
+        emb_mat = emb_mat[:len(token2idx_dict)]
+        print("{} / {} tokens have corresponding {} embedding vector".format(len(token2idx_dict) - 2, len(filtered_elements), data_type))
+        if cache_file is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            np.save(cache_file + ".npy", emb_mat)
+            with open(cache_file + ".json", "w", encoding="utf-8") as fh:
+                json.dump(token2idx_dict, fh)
     else:
         assert vec_size is not None
         for token in filtered_elements:
-            embedding_dict[token] = [np.random.normal(scale=0.1) for _ in range(vec_size)]
+            token2idx_dict.setdefault(token, len(token2idx_dict))
+        emb_mat = np.random.normal(scale=0.1, size=[len(token2idx_dict), vec_size]).astype(np.float32)
+        emb_mat[:2] = 0.
         print("{} tokens have corresponding embedding vector".format(len(filtered_elements)))
-    NULL = "--NULL--"
-    OOV = "--OOV--"
-    token2idx_dict = {token: idx for idx, token in enumerate(embedding_dict.keys(), 2)}
-    token2idx_dict[NULL] = 0
-    token2idx_dict[OOV] = 1
-    embedding_dict[NULL] = [0. for _ in range(vec_size)]
-    embedding_dict[OOV] = [0. for _ in range(vec_size)]
-    idx2emb_dict = {idx: embedding_dict[token] for token, idx in token2idx_dict.items()}
-    emb_mat = [idx2emb_dict[idx] for idx in range(len(idx2emb_dict))]
     return emb_mat, token2idx_dict
 
 
-def build_features(config, examples, data_type, out_file, word2idx_dict, is_test=False):
-    para_limit = config.test_para_limit if is_test else config.para_limit
-    ques_limit = config.test_ques_limit if is_test else config.ques_limit
-    ans_limit = 100 if is_test else config.ans_limit
+def get_shard_file(out_file, shard, num_shards):
+    if num_shards == 1:
+        return out_file
+    return "{}-{:05d}-of-{:05d}".format(out_file, shard, num_shards)
+
+
+_shard_word2idx = None
+
+
+def _init_shard_worker(word2idx_dict):
+    global _shard_word2idx
+    _shard_word2idx = word2idx_dict
+
+
+def _write_shard(args):
+    # input: args: (examples, out_file, para_limit, ques_limit, ans_limit, is_test)
+    # output: number of written examples, number of seen examples and the context length histogram
+    examples, out_file, para_limit, ques_limit, ans_limit, is_test = args
+    word2idx_dict = _shard_word2idx
 
     def filter_func(example, is_test=False):
         if len(example["y2s"]) == 0 or len(example["y1s"]) == 0:
@@ -115,47 +247,71 @@ def build_features(config, examples, data_type, out_file, word2idx_dict, is_test
                len(example["ques_tokens"]) > ques_limit or \
                (example["y2s"][0] - example["y1s"][0]) > ans_limit
 
-    print("Processing {} examples...".format(data_type))
+    def _get_word(word):
+        for each in (word, word.lower(), word.capitalize(), word.upper()):
+            if each in word2idx_dict:
+                return word2idx_dict[each]
+        return 1
+
     writer = tf.python_io.TFRecordWriter(out_file)
     total = 0
     total_ = 0
-    meta = {}
-    for example in tqdm(examples):
+    context_len_hist = [0] * (para_limit + 1)
+    for example in examples:
         total_ += 1
         if filter_func(example, is_test):
             continue
         total += 1
-        context_idxs = np.zeros([para_limit], dtype=np.int32)
-        ques_idxs = np.zeros([ques_limit], dtype=np.int32)
-        y1 = np.zeros([para_limit], dtype=np.float32)
-        y2 = np.zeros([para_limit], dtype=np.float32)
-
-        def _get_word(word):
-            for each in (word, word.lower(), word.capitalize(), word.upper()):
-                if each in word2idx_dict:
-                    return word2idx_dict[each]
-            return 1
-
-        for i, token in enumerate(example["context_tokens"]):
-            context_idxs[i] = _get_word(token)
-
-        for i, token in enumerate(example["ques_tokens"]):
-            ques_idxs[i] = _get_word(token)
 
+        # token ids are stored unpadded and the answer as its start/end index, padding happens at batch time
+        context_idxs = [_get_word(token) for token in example["context_tokens"]]
+        ques_idxs = [_get_word(token) for token in example["ques_tokens"]]
         start, end = example["y1s"][-1], example["y2s"][-1]
-        y1[start], y2[end] = 1.0, 1.0
+        context_len_hist[len(context_idxs)] += 1
 
         record = tf.train.Example(features=tf.train.Features(feature={
-                                  "context_idxs": tf.train.Feature(bytes_list=tf.train.BytesList(value=[context_idxs.tostring()])),
-                                  "ques_idxs": tf.train.Feature(bytes_list=tf.train.BytesList(value=[ques_idxs.tostring()])),
-                                  "y1": tf.train.Feature(bytes_list=tf.train.BytesList(value=[y1.tostring()])),
-                                  "y2": tf.train.Feature(bytes_list=tf.train.BytesList(value=[y2.tostring()])),
+                                  "context_idxs": tf.train.Feature(int64_list=tf.train.Int64List(value=context_idxs)),
+                                  "ques_idxs": tf.train.Feature(int64_list=tf.train.Int64List(value=ques_idxs)),
+                                  "y1": tf.train.Feature(int64_list=tf.train.Int64List(value=[start])),
+                                  "y2": tf.train.Feature(int64_list=tf.train.Int64List(value=[end])),
                                   "id": tf.train.Feature(int64_list=tf.train.Int64List(value=[example["id"]]))
                                   }))
         writer.write(record.SerializeToString())
-    print("Built {} / {} instances of features in total".format(total, total_))
-    meta["total"] = total
     writer.close()
+    return total, total_, context_len_hist
+
+
+def build_features(config, examples, data_type, out_file, word2idx_dict, is_test=False):
+    para_limit = config.test_para_limit if is_test else config.para_limit
+    ques_limit = config.test_ques_limit if is_test else config.ques_limit
+    ans_limit = config.test_ans_limit if is_test else config.ans_limit
+    num_shards = max(1, config.num_shards)
+
+    print("Processing {} examples...".format(data_type))
+    # drop shards of a previous run so that readers do not pick up stale files
+    for stale_file in tf.gfile.Glob(out_file + "-*-of-*"):
+        tf.gfile.Remove(stale_file)
+    tasks = [(examples[shard::num_shards], get_shard_file(out_file, shard, num_shards),
+              para_limit, ques_limit, ans_limit, is_test) for shard in range(num_shards)]
+    if config.prepro_workers > 1 and num_shards > 1:
+        pool = Pool(min(config.prepro_workers, num_shards), initializer=_init_shard_worker, initargs=(word2idx_dict,))
+        results = pool.imap(_write_shard, tasks)
+    else:
+        pool = None
+        _init_shard_worker(word2idx_dict)
+        results = map(_write_shard, tasks)
+    total = 0
+    total_ = 0
+    context_len_hist = [0] * (para_limit + 1)
+    for shard_total, shard_total_, shard_hist in tqdm(results, total=num_shards):
+        total += shard_total
+        total_ += shard_total_
+        context_len_hist = [a + b for a, b in zip(context_len_hist, shard_hist)]
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("Built {} / {} instances of features in {} shard(s)".format(total, total_, num_shards))
+    meta = {"total": total, "num_shards": num_shards, "context_len_hist": context_len_hist}
     return meta
 
 
@@ -166,25 +322,167 @@ def save(filename, obj, message=None):
             json.dump(obj, fh)
 
 
+def save_embedding(filename, emb_mat, message=None):
+    # the .npy header keeps dtype and shape, so consumers can memory-map the raw float32 matrix
+    if message is not None:
+        print("Saving {}...".format(message))
+    np.save(filename, np.asarray(emb_mat, dtype=np.float32))
+
+
+def save_eval(path, eval_examples, message=None):
+    # write the eval examples {id: {context, spans, answers, uuid}} as an util.EvalStore directory,
+    # every distinct context (and its token spans) once
+    if message is not None:
+        print("Saving {}...".format(message))
+    if not os.path.exists(path):
+        os.makedirs(path)
+    ids = sorted(int(key) for key in eval_examples)
+    context_index = {}
+    context_chars, context_offsets = [], [0]
+    span_starts, span_ends, span_offsets = [], [], [0]
+    example_context, answers, uuids = [], [], []
+    for qa_id in ids:
+        example = eval_examples[str(qa_id)]
+        context = example["context"]
+        if context not in context_index:
+            context_index[context] = len(context_index)
+            context_chars.append(np.frombuffer(context.encode("utf-32-le"), dtype="<u4"))
+            context_offsets.append(context_offsets[-1] + len(context))
+            span_starts.extend(start for start, _ in example["spans"])
+            span_ends.extend(end for _, end in example["spans"])
+            span_offsets.append(len(span_starts))
+        example_context.append(context_index[context])
+        answers.append(example["answers"])
+        uuids.append(example["uuid"])
+    arrays = {"context_chars": np.concatenate(context_chars) if context_chars else np.zeros([0], dtype="<u4"),
+              "context_offsets": np.asarray(context_offsets, dtype=np.int64),
+              "span_offsets": np.asarray(span_offsets, dtype=np.int64),
+              "span_starts": np.asarray(span_starts, dtype=np.int32),
+              "span_ends": np.asarray(span_ends, dtype=np.int32),
+              "ids": np.asarray(ids, dtype=np.int64),
+              "example_context": np.asarray(example_context, dtype=np.int32)}
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+    with open(os.path.join(path, "answers.json"), "w") as fh:
+        json.dump({"answers": answers, "uuids": uuids}, fh)
+
+
+def _hash_file(filename, block_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(filename, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _hash_obj(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class PreproCache(object):
+    """Content-addressed cache of the prepro stages.
+
+    Intermediate results (example lists) are pickled under the hash of their inputs, and a
+    manifest maps every output file to the hash of the inputs it was written from, so a stage
+    is only re-run when its source file or one of its parameters changed.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.manifest_file = os.path.join(cache_dir, "manifest.json") if cache_dir else None
+        self.manifest = {}
+        if self.manifest_file and os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r", encoding="utf-8") as fh:
+                self.manifest = json.load(fh)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def load(self, name, key):
+        if not self.cache_dir:
+            return None
+        cache_file = os.path.join(self.cache_dir, "{}_{}.pkl".format(name, key))
+        if not os.path.exists(cache_file):
+            return None
+        with open(cache_file, "rb") as fh:
+            return pickle.load(fh)
+
+    def dump(self, name, key, obj):
+        if not self.cache_dir:
+            return
+        # drop results of older inputs for the same stage
+        for stale_file in tf.gfile.Glob(os.path.join(self.cache_dir, "{}_*.pkl".format(name))):
+            tf.gfile.Remove(stale_file)
+        with open(os.path.join(self.cache_dir, "{}_{}.pkl".format(name, key)), "wb") as fh:
+            pickle.dump(obj, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def is_fresh(self, out_files, key):
+        # input: out_files: the files written by one stage, the first one names the stage in the manifest
+        entry = self.manifest.get(out_files[0])
+        return entry is not None and entry["key"] == key and all(os.path.exists(f) for f in out_files)
+
+    def mark(self, out_file, key):
+        if not self.manifest_file:
+            return
+        self.manifest[out_file] = {"key": key}
+        with open(self.manifest_file, "w", encoding="utf-8") as fh:
+            json.dump(self.manifest, fh)
+
+
+def load_examples(config, cache, filename, data_type, word_counter):
+    key = _hash_obj([data_type, _hash_file(filename)])
+    cached = cache.load("{}_examples".format(data_type), key)
+    if cached is not None:
+        print("Loading cached {} examples...".format(data_type))
+        examples, eval_examples, counter = cached
+    else:
+        counter = Counter()
+        examples, eval_examples = process_file(filename, data_type, counter, config.prepro_workers)
+        cache.dump("{}_examples".format(data_type), key, (examples, eval_examples, counter))
+    word_counter.update(counter)
+    return examples, eval_examples, key
+
+
 def prepro(config):
+    cache = PreproCache(config.prepro_cache_dir)
     word_counter = Counter()
-    train_examples, train_eval = process_file(config.train_file, "train", word_counter)
-    dev_examples, dev_eval = process_file(config.dev_file, "dev", word_counter)
-    test_examples, test_eval = process_file(config.test_file, "test", word_counter)
+    train_examples, train_eval, train_key = load_examples(config, cache, config.train_file, "train", word_counter)
+    dev_examples, dev_eval, dev_key = load_examples(config, cache, config.dev_file, "dev", word_counter)
+    test_examples, test_eval, test_key = load_examples(config, cache, config.test_file, "test", word_counter)
 
     word_emb_file = config.fasttext_file if config.fasttext else config.glove_word_file
 
     word_emb_mat, word2idx_dict = get_embedding(word_counter, "word", emb_file=word_emb_file,
-                                                size=config.glove_word_size, vec_size=config.glove_dim)
-
-    build_features(config, train_examples, "train", config.train_record_file, word2idx_dict)
-    dev_meta = build_features(config, dev_examples, "dev", config.dev_record_file, word2idx_dict)
-    test_meta = build_features(config, test_examples, "test", config.test_record_file, word2idx_dict, is_test=True)
-
-    save(config.train_eval_file, train_eval, message="train eval")
-    save(config.dev_eval_file, dev_eval, message="dev eval")
-    save(config.test_eval_file, test_eval, message="test eval")
-    save(config.dev_meta, dev_meta, message="dev meta")
-    save(config.test_meta, test_meta, message="test meta")
-    save(config.word_emb_file, word_emb_mat, message="word embedding")
-    save(config.word_dictionary, word2idx_dict, message="word dictionary")
+                                                size=config.glove_word_size, vec_size=config.glove_dim,
+                                                num_workers=config.emb_workers, cache_dir=config.emb_cache_dir)
+    # the records only depend on the dictionary, the embedding matrix also on the vectors of the embedding file
+    vocab_key = _hash_obj(sorted(word2idx_dict.items(), key=lambda item: item[1]))
+    emb_key = _hash_obj([vocab_key, _file_stamp(word_emb_file), config.glove_dim])
+
+    for examples, examples_key, data_type, record_file, meta_file, is_test in [
+            (train_examples, train_key, "train", config.train_record_file, config.train_meta, False),
+            (dev_examples, dev_key, "dev", config.dev_record_file, config.dev_meta, False),
+            (test_examples, test_key, "test", config.test_record_file, config.test_meta, True)]:
+        limits = [config.test_para_limit, config.test_ques_limit, config.test_ans_limit] if is_test else \
+            [config.para_limit, config.ques_limit, config.ans_limit]
+        key = _hash_obj([examples_key, vocab_key, limits, config.num_shards])
+        num_shards = max(1, config.num_shards)
+        record_files = [get_shard_file(record_file, shard, num_shards) for shard in range(num_shards)]
+        if cache.is_fresh(record_files + [meta_file], key):
+            print("{} records are up to date".format(data_type))
+            continue
+        meta = build_features(config, examples, data_type, record_file, word2idx_dict, is_test=is_test)
+        save(meta_file, meta, message="{} meta".format(data_type))
+        cache.mark(record_files[0], key)
+
+    for eval_examples, examples_key, data_type, eval_file in [
+            (train_eval, train_key, "train", config.train_eval_file),
+            (dev_eval, dev_key, "dev", config.dev_eval_file),
+            (test_eval, test_key, "test", config.test_eval_file)]:
+        if cache.is_fresh([eval_file], examples_key):
+            continue
+        save_eval(eval_file, eval_examples, message="{} eval".format(data_type))
+        cache.mark(eval_file, examples_key)
+
+    if not cache.is_fresh([config.word_emb_file, config.word_dictionary], emb_key):
+        save_embedding(config.word_emb_file, word_emb_mat, message="word embedding")
+        save(config.word_dictionary, word2idx_dict, message="word dictionary")
+        cache.mark(config.word_emb_file, emb_key)
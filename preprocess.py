@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import threading
 import numpy as np
+from collections import OrderedDict
 import jieba
 
 jieba.add_word("XXX")
@@ -10,10 +12,9 @@ def word_tokenize(sent):
     return jieba.lcut(sent)
 
 
-def _get_word(word, word2idx_dict):
-    if word in word2idx_dict:
-        return word2idx_dict[word]
-    return 1
+def lookup_ids(tokens, word2idx_dict):
+    # output: an int32 array of the token ids, 1 (--OOV--) for unknown tokens, built in one pass
+    return np.fromiter(map(word2idx_dict.get, tokens, [1] * len(tokens)), dtype=np.int32, count=len(tokens))
 
 
 def preprocess(query, config, word2idx_dict, query_type=None):
@@ -31,6 +32,58 @@ def preprocess(query, config, word2idx_dict, query_type=None):
         return None, None
     # generate indexes data
     ques_idxs = np.zeros([1, ques_limit], dtype=np.int32)
-    for i, token in enumerate(seg_query):
-        ques_idxs[0, i] = _get_word(token, word2idx_dict)
+    ques_idxs[0, :len(seg_query)] = lookup_ids(seg_query, word2idx_dict)
     return ques_idxs, seg_query
+
+
+class Tokenizer(object):
+    """Segment texts with jieba and map them to ids, remembering the most recent contexts.
+
+    tokenize returns (ids, tokens, spans): a read-only int32 id array, the jieba tokens and the
+    (start, end) character offsets of every token. Texts tokenized with cache=True are kept in
+    an LRU cache of cache_size entries, so passages asked about again skip segmentation.
+    The jieba dictionary is loaded when the tokenizer is built, not by the first request.
+    """
+    def __init__(self, word2idx_dict, cache_size=1024):
+        jieba.initialize()
+        self.word2idx_dict = word2idx_dict
+        self.cache_size = cache_size
+        self.hits = self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def tokenize(self, text, cache=False):
+        if cache and self.cache_size > 0:
+            with self._lock:
+                result = self._cache.get(text)
+                if result is not None:
+                    self._cache.move_to_end(text)
+                    self.hits += 1
+                    return result
+                self.misses += 1
+        tokens, spans = [], []
+        for token, start, end in jieba.tokenize(text):
+            tokens.append(token)
+            spans.append((start, end))
+        ids = lookup_ids(tokens, self.word2idx_dict)
+        # cached results are shared between requests
+        ids.setflags(write=False)
+        result = (ids, tokens, spans)
+        if cache and self.cache_size > 0:
+            with self._lock:
+                self._cache[text] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+
+def split_windows(length, window, stride):
+    # input: length: number of context tokens,
+    #        window: max tokens per window,
+    #        stride: tokens between the starts of two consecutive windows
+    # output: a list of overlapping (start, end) token ranges covering [0, length)
+    if length <= window:
+        return [(0, length)]
+    starts = list(range(0, length - window, max(1, stride)))
+    starts.append(length - window)
+    return [(start, start + window) for start in starts]
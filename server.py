@@ -8,55 +8,56 @@ import ujson as json
 from tqdm import tqdm
 import tensorflow as tf
 from collections import Counter
-from flask import Flask, request
+from flask import Flask, request, jsonify
 
 import jieba
-from model import Model
 from config import flags
-from preprocess import preprocess
+from engine import BatchInferenceEngine, run_batch
+from export import load_inference_model
+from preprocess import Tokenizer
+from util import load_embedding
 
 
 ### Global Setting
 app = Flask(__name__)
 config = flags.FLAGS
-graph = tf.Graph()
-with open(config.word_emb_file, "r") as fh:
-    word_mat = np.array(json.load(fh), dtype=np.float32)
+word_mat = load_embedding(config.word_emb_file)
 with open(config.word_dictionary,'r') as f:
     word_dict = json.load(f)
 
-model = Model(config, word_mat=word_mat, trainable=False, opt=False, demo=True, graph = graph)
-
-default_q = [[1,2]]
-default_c = [[3,4]]
-with graph.as_default() as g:
-    sess_config = tf.ConfigProto(allow_soft_placement=True)
-    sess_config.gpu_options.allow_growth = True
-    sess = tf.Session(config=sess_config)
-    sess.run(tf.global_variables_initializer())
-    saver = tf.train.Saver()
-    saver.restore(sess, tf.train.latest_checkpoint(config.save_dir))
-    if config.decay < 1.0:
-        sess.run(model.assign_vars)
-    qa_id, logits, yp1, yp2 = sess.run([model.qa_id, model.logits, model.yp1, model.yp2], 
-                                       feed_dict={model.c:default_c, model.q:default_q})
+sess, model = load_inference_model(config, word_mat)
+default_q = [[1, 2]]
+default_c = [[3, 4]]
+run_batch(sess, model, default_c, default_q)
+tokenizer = Tokenizer(word_dict, config.tokenizer_cache_size)
+engine = BatchInferenceEngine(sess, model, max_batch_size=config.batch_max_size, max_wait_ms=config.batch_timeout_ms,
+                              cache_bytes=config.context_cache_mb * 1024 * 1024)
 
     
-def readingComprehension(para, query):
-    c, seg_c = preprocess(para, config, word_dict)
-    q, _ = preprocess(query, config, word_dict)
-    qa_id, logits, yp1, yp2 = sess.run([model.qa_id, model.logits, model.yp1, model.yp2], 
-                                       feed_dict={model.c:c, model.q:q})
-    answer = ''.join(seg_c[yp1[0]: yp2[0]+1])     
-    return answer
+def readingComprehension(para, query, top_k=1):
+    # output: up to top_k candidates, best first, each with its text, [start, end) character
+    #         offsets into para and its span probability
+    # the same passages come back with new questions, their segmentation is cached
+    c, seg_c, char_spans = tokenizer.tokenize(para, cache=True)
+    q, _, _ = tokenizer.tokenize(query)
+    spans = engine.infer_windows(c, q, config.doc_window, config.doc_stride, top_k=top_k)
+    candidates = []
+    for yp1, yp2, prob in spans:
+        candidates.append({"text": ''.join(seg_c[yp1: yp2+1]),
+                           "start": char_spans[yp1][0], "end": char_spans[yp2][1],
+                           "prob": float(prob)})
+    return candidates
 
 
 @app.route("/", methods=["POST"])
 def hello():
     json_str = request.json
     context, question = json_str.get("context"), json_str.get("question")
-    result = readingComprehension(context, question)
-    return str(result)
+    # the graph decodes config.top_k spans, a request may ask for fewer
+    top_k = min(max(int(json_str.get("top_k", 1)), 1), config.top_k)
+    candidates = readingComprehension(context, question, top_k)
+    answer = candidates[0]["text"] if candidates else ""
+    return jsonify({"answer": answer, "candidates": candidates})
 
 
 if __name__ == '__main__':
@@ -1,121 +1,347 @@
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import sys
+import json as json
+import bisect
 import string
+import numpy as np
 from collections import Counter
+from multiprocessing import Pool
 import tensorflow as tf
 import jieba
 
 
-def get_record_parser(config, is_test=False):
+def argv_without_mode():
+    # output: the command line flags of this process except --mode, to start the same script in another mode
+    argv = []
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "--mode":
+            next(args, None)
+        elif not arg.startswith("--mode="):
+            argv.append(arg)
+    return argv
+
+
+def load_embedding(filename):
+    # input: filename: the .npy file written by prepro.save_embedding
+    # output: a read-only float32 matrix backed by the page cache, shared by all processes mapping it
+    return np.load(filename, mmap_mode="r")
+
+
+def get_record_parser(config, batched=False):
+    # records hold unpadded token ids and scalar answer indices, see prepro.build_features
+    # batched: parse a batch of serialized records with one parse_example, the token ids are
+    #          padded with 0 to the longest context/question of the batch, as padded_batch does
+    features = {"context_idxs": tf.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
+                "ques_idxs": tf.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
+                "y1": tf.FixedLenFeature([], tf.int64),
+                "y2": tf.FixedLenFeature([], tf.int64),
+                "id": tf.FixedLenFeature([], tf.int64)}
+
     def parse(example):
-        para_limit = config.test_para_limit if is_test else config.para_limit
-        ques_limit = config.test_ques_limit if is_test else config.ques_limit
-        features = tf.parse_single_example(example, features={"context_idxs": tf.FixedLenFeature([], tf.string),
-                                                              "ques_idxs": tf.FixedLenFeature([], tf.string),
-                                                              "y1": tf.FixedLenFeature([], tf.string),
-                                                              "y2": tf.FixedLenFeature([], tf.string),
-                                                              "id": tf.FixedLenFeature([], tf.int64)})
-        context_idxs = tf.reshape(tf.decode_raw(features["context_idxs"], tf.int32), [para_limit])
-        ques_idxs = tf.reshape(tf.decode_raw(features["ques_idxs"], tf.int32), [ques_limit])
-        y1 = tf.reshape(tf.decode_raw(features["y1"], tf.float32), [para_limit])
-        y2 = tf.reshape(tf.decode_raw(features["y2"], tf.float32), [para_limit])
-        qa_id = features["id"]
+        if batched:
+            parsed = tf.parse_example(example, features=features)
+        else:
+            parsed = tf.parse_single_example(example, features=features)
+        context_idxs = tf.cast(parsed["context_idxs"], tf.int32)
+        ques_idxs = tf.cast(parsed["ques_idxs"], tf.int32)
+        y1 = tf.cast(parsed["y1"], tf.int32)
+        y2 = tf.cast(parsed["y2"], tf.int32)
+        qa_id = parsed["id"]
         return context_idxs, ques_idxs, y1, y2, qa_id
     return parse
 
 
-def get_batch_dataset(record_file, parser, config):
+# pad token ids to the longest context/question of each batch, answers and ids are scalars
+padded_shapes = ([None], [None], [], [], [])
+
+
+def get_record_files(record_file):
+    # input: record_file: the record path from config, written whole or as "<record_file>-xxxxx-of-xxxxx" shards
+    # output: the list of record files to read
+    shards = sorted(tf.gfile.Glob(record_file + "-*-of-*"))
+    return shards if shards else [record_file]
+
+
+def get_record_dataset(record_file, config, shuffle_files=False, num_shards=1, shard_index=0):
+    # num_shards, shard_index: data-parallel replicas read disjoint parts of the records
+    files = get_record_files(record_file)
+    if num_shards > 1:
+        if len(files) >= num_shards:
+            files = files[shard_index::num_shards]
+        else:
+            return get_record_dataset(record_file, config, shuffle_files).shard(num_shards, shard_index)
+    if len(files) == 1:
+        return tf.data.TFRecordDataset(files)
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle_files:
+        dataset = dataset.shuffle(len(files))
+    # read several shards at once so that I/O and parsing scale with the number of threads
+    return dataset.apply(tf.contrib.data.parallel_interleave(
+        tf.data.TFRecordDataset, cycle_length=min(config.num_threads, len(files)), sloppy=shuffle_files))
+
+
+def get_bucket_boundaries(length_hist, num_buckets):
+    # input: length_hist: counts of examples per context length, written by prepro into the train meta,
+    #        num_buckets: the number of buckets wanted
+    # output: increasing length boundaries splitting the examples into buckets of roughly equal size
+    total = sum(length_hist)
+    boundaries = []
+    if total == 0:
+        return boundaries
+    seen = 0
+    for length, count in enumerate(length_hist):
+        seen += count
+        if len(boundaries) + 1 < num_buckets and seen >= total * (len(boundaries) + 1) / num_buckets:
+            if length + 1 < len(length_hist) and (not boundaries or boundaries[-1] < length + 1):
+                boundaries.append(length + 1)
+    return boundaries
+
+
+_AUTOTUNE = getattr(getattr(tf.data, "experimental", None), "AUTOTUNE", None)
+
+
+def _prefetch(dataset, config):
+    # --prefetch_batches 0 lets tf.data size the buffer, where the TF version supports it
+    if config.prefetch_batches > 0 or _AUTOTUNE is None:
+        return dataset.prefetch(max(config.prefetch_batches, 1))
+    return dataset.prefetch(_AUTOTUNE)
+
+
+def get_batch_dataset(record_file, parser, config, bucket_boundaries=None, num_shards=1, shard_index=0):
+    # parser: the per-example parser from get_record_parser, used to bucket the examples by length;
+    #         without buckets the serialized records are shuffled and batched, then parsed per batch
     num_threads = tf.constant(config.num_threads, dtype=tf.int32)
-    dataset = tf.data.TFRecordDataset(record_file).map(parser, num_parallel_calls=num_threads).shuffle(config.capacity).repeat()
+    dataset = get_record_dataset(record_file, config, shuffle_files=True, num_shards=num_shards,
+                                 shard_index=shard_index).shuffle(config.capacity).repeat()
     if config.is_bucket:
-        buckets = [tf.constant(num) for num in range(*config.bucket_range)]
-
-        def key_func(context_idxs):
-            c_len = tf.reduce_sum(tf.cast(tf.cast(context_idxs, tf.bool), tf.int32))
-            t = tf.clip_by_value(buckets, 0, c_len)
-            return tf.argmax(t)
+        if not bucket_boundaries:
+            bucket_boundaries = list(range(*[int(num) for num in config.bucket_range]))
 
-        def reduce_func(elements):
-            return elements.batch(config.batch_size)
+        def length_func(context_idxs, ques_idxs, y1, y2, qa_id):
+            return tf.shape(context_idxs)[0]
 
-        dataset = dataset.apply(tf.contrib.data.group_by_window(key_func, reduce_func, window_size=5 * config.batch_size)).shuffle(len(buckets) * 25)
+        # every bucket is padded to its own longest context, not to para_limit
+        dataset = dataset.map(parser, num_parallel_calls=num_threads).apply(tf.contrib.data.bucket_by_sequence_length(
+            length_func, bucket_boundaries, [config.batch_size] * (len(bucket_boundaries) + 1),
+            padded_shapes=padded_shapes)).shuffle(len(bucket_boundaries) * 25)
     else:
-        dataset = dataset.batch(config.batch_size)
-    return dataset
+        dataset = dataset.batch(config.batch_size).map(get_record_parser(config, batched=True),
+                                                      num_parallel_calls=num_threads)
+    return _prefetch(dataset, config)
 
 
-def get_dataset(record_file, parser, config):
+def get_dataset(record_file, config, cache=False):
+    # cache: keep the serialized records in memory after the first pass (dev sets read at every checkpoint)
     num_threads = tf.constant(config.num_threads, dtype=tf.int32)
-    dataset = tf.data.TFRecordDataset(record_file).map(parser, num_parallel_calls=num_threads).repeat().batch(config.batch_size)
-    return dataset
+    dataset = get_record_dataset(record_file, config)
+    if cache:
+        dataset = dataset.cache()
+    dataset = dataset.repeat().batch(config.batch_size).map(get_record_parser(config, batched=True),
+                                                            num_parallel_calls=num_threads)
+    return _prefetch(dataset, config)
+
+
+class BucketStats(object):
+    """Throughput and padding of the training batches, grouped by the bucket of their longest context."""
+    def __init__(self, boundaries=None):
+        self.boundaries = list(boundaries or [])
+        num_buckets = len(self.boundaries) + 1
+        self.steps = [0] * num_buckets
+        self.tokens = [0] * num_buckets
+        self.padded = [0] * num_buckets
+        self.seconds = [0.] * num_buckets
+
+    def update(self, c_len, seconds):
+        # input: c_len: context lengths of one batch, seconds: wall time of its training step
+        max_len = max(c_len)
+        bucket = bisect.bisect_right(self.boundaries, max_len)
+        self.steps[bucket] += 1
+        self.tokens[bucket] += sum(c_len)
+        self.padded[bucket] += max_len * len(c_len)
+        self.seconds[bucket] += seconds
+
+    def report(self):
+        # output: one line per bucket and the corresponding tf.Summary values, then resets the counters
+        lines, values = [], []
+        lower = [0] + self.boundaries
+        upper = self.boundaries + [None]
+        for i in range(len(self.steps)):
+            if self.steps[i] == 0:
+                continue
+            tokens_per_sec = self.tokens[i] / max(self.seconds[i], 1e-9)
+            padding_ratio = 1.0 - float(self.tokens[i]) / self.padded[i]
+            lines.append("bucket {} [{}, {}): {} steps, {:.1f} tokens/sec, padding ratio {:.3f}".format(
+                i, lower[i], upper[i] if upper[i] is not None else "inf", self.steps[i], tokens_per_sec, padding_ratio))
+            values.append(tf.Summary.Value(tag="bucket_{}/tokens_per_sec".format(i), simple_value=tokens_per_sec))
+            values.append(tf.Summary.Value(tag="bucket_{}/padding_ratio".format(i), simple_value=padding_ratio))
+        self.__init__(self.boundaries)
+        return lines, tf.Summary(value=values)
+
+
+class EvalStore(object):
+    """Columnar eval file written by prepro.save_eval, a directory of memory-mapped arrays:
+
+    context_chars.npy    uint32 code points of every distinct context, concatenated
+    context_offsets.npy  int64 [num_contexts + 1], context i is context_chars[offsets[i]: offsets[i + 1]]
+    span_offsets.npy     int64 [num_contexts + 1], token spans of context i in span_starts/span_ends
+    span_starts.npy      int32 character start of every context token, relative to its context
+    span_ends.npy        int32 character end of every context token
+    ids.npy              int64 example ids in increasing order
+    example_context.npy  int32 context index of every example, aligned with ids
+    answers.json         {"answers": [[...], ...], "uuids": [...]}, aligned with ids
+
+    A context asked by several questions is stored once.
+    """
+    def __init__(self, path):
+        self.path = path
+        for name in ("context_chars", "context_offsets", "span_offsets", "span_starts", "span_ends", "ids",
+                     "example_context"):
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+        with open(os.path.join(path, "answers.json"), "r") as fh:
+            sidecar = json.load(fh)
+        self.answers = sidecar["answers"]
+        self.uuids = sidecar["uuids"]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, qa_ids):
+        # input: qa_ids: example ids (ints or their str keys)
+        # output: the int64 rows of the examples in the aligned arrays
+        qa_ids = np.asarray(qa_ids, dtype=np.int64)
+        rows = np.searchsorted(self.ids, qa_ids)
+        if np.any(rows >= len(self.ids)) or np.any(self.ids[np.minimum(rows, len(self.ids) - 1)] != qa_ids):
+            raise KeyError("unknown example id in {}".format(self.path))
+        return rows
+
+    def get_answers(self, key):
+        return self.answers[int(self.rows([int(key)])[0])]
 
 
 def convert_tokens(eval_file, qa_id, pp1, pp2):
+    # input: eval_file: an EvalStore,
+    #        qa_id, pp1, pp2: example ids and predicted start/end tokens of one batch (lists or arrays)
+    # output: {str(id): answer} and {uuid: answer}
+    # the character offsets of the whole batch are gathered with numpy and decoded at once
+    qa_id = np.asarray(qa_id, dtype=np.int64)
+    rows = eval_file.rows(qa_id)
+    contexts = eval_file.example_context[rows]
+    span_base = eval_file.span_offsets[contexts]
+    char_base = eval_file.context_offsets[contexts]
+    starts = char_base + eval_file.span_starts[span_base + np.asarray(pp1, dtype=np.int64)]
+    ends = char_base + eval_file.span_ends[span_base + np.asarray(pp2, dtype=np.int64)]
+    lengths = np.maximum(ends - starts, 0)
+    # the concatenated [start, end) ranges of all answers, as one index array
+    offsets = np.cumsum(lengths) - lengths
+    index = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum(), dtype=np.int64)
+    text = np.asarray(eval_file.context_chars[index]).astype("<u4").tobytes().decode("utf-32-le")
     answer_dict = {}
     remapped_dict = {}
-    for qid, p1, p2 in zip(qa_id, pp1, pp2):
-        context = eval_file[str(qid)]["context"]
-        spans = eval_file[str(qid)]["spans"]
-        uuid = eval_file[str(qid)]["uuid"]
-        start_idx = spans[p1][0]
-        end_idx = spans[p2][1]
-        answer_dict[str(qid)] = context[start_idx: end_idx]
-        remapped_dict[uuid] = context[start_idx: end_idx]
+    for qid, row, offset, length in zip(qa_id.tolist(), rows.tolist(), offsets.tolist(), lengths.tolist()):
+        answer = text[offset: offset + length]
+        answer_dict[str(qid)] = answer
+        remapped_dict[eval_file.uuids[row]] = answer
     return answer_dict, remapped_dict
 
 
 def evaluate(eval_file, answer_dict):
-    f1 = exact_match = total = 0
-    for key, value in answer_dict.items():
-        total += 1
-        ground_truths = eval_file[key]["answers"]
-        prediction = value
-        exact_match += metric_max_over_ground_truths(exact_match_score, prediction, ground_truths)
-        f1 += metric_max_over_ground_truths(f1_score, prediction, ground_truths)
-    exact_match = 100.0 * exact_match / total
-    f1 = 100.0 * f1 / total
-    return {'exact_match': exact_match, 'f1': f1}
+    return Evaluator(eval_file).evaluate(answer_dict)
 
 
-def normalize_answer(s):
+_init_evaluator = None
+
 
-    def remove_articles(text):
-        return re.sub(r'\b(a|an|the)\b', ' ', text)
+def _init_eval_worker(eval_file):
+    global _init_evaluator
+    _init_evaluator = Evaluator(eval_file)
 
-    def white_space_fix(text):
-        return ' '.join(text.split())
 
-    def remove_punc(text):
-        exclude = set(string.punctuation+'，。！？·、：；（）【】{}““\’')
-        return ''.join(ch for ch in text if ch not in exclude)
+def _score_chunk(items):
+    return _init_evaluator.score(items)
 
-    def lower(text):
-        return text.lower()
 
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+class Evaluator(object):
+    """EM/F1 of answer dicts against one EvalStore, the same numbers as evaluate.
 
+    The normalized and segmented ground truths of an example are computed the first time it
+    is scored and kept for the next evaluations; with num_workers > 1 the predictions are
+    scored in a pool of processes, each keeping its own cache.
+    """
+    def __init__(self, eval_file, num_workers=1):
+        self.eval_file = eval_file
+        self._truths = {}
+        self._pool = None
+        if num_workers > 1:
+            self._pool = Pool(num_workers, initializer=_init_eval_worker, initargs=(eval_file,))
+            self._num_workers = num_workers
 
-def f1_score(prediction, ground_truth):
-    prediction_tokens = jieba.lcut(normalize_answer(prediction))
-    ground_truth_tokens = jieba.lcut(normalize_answer(ground_truth))
-    common = Counter(prediction_tokens) & Counter(ground_truth_tokens)
-    num_same = sum(common.values())
-    if num_same == 0:
-        return 0
-    precision = 1.0 * num_same / len(prediction_tokens)
-    recall = 1.0 * num_same / len(ground_truth_tokens)
-    f1 = (2 * precision * recall) / (precision + recall)
-    return f1
+    def ground_truths(self, key):
+        # output: (normalized answer, Counter of its tokens, number of tokens) per answer of the example
+        if key not in self._truths:
+            truths = []
+            for answer in self.eval_file.get_answers(key):
+                normalized = normalize_answer(answer)
+                tokens = jieba.lcut(normalized)
+                truths.append((normalized, Counter(tokens), len(tokens)))
+            self._truths[key] = truths
+        return self._truths[key]
 
+    def score(self, items):
+        # input: items: (key, prediction) pairs
+        # output: (exact match, f1) per pair, each the max over the ground truths of the example;
+        #         F1 is over the jieba tokens of the normalized answers
+        scores = []
+        for key, prediction in items:
+            normalized = normalize_answer(prediction)
+            prediction_tokens = jieba.lcut(normalized)
+            prediction_counter = Counter(prediction_tokens)
+            exact_match, f1 = [], []
+            for truth, truth_counter, num_truth_tokens in self.ground_truths(key):
+                exact_match.append(normalized == truth)
+                num_same = sum((prediction_counter & truth_counter).values())
+                if num_same == 0:
+                    f1.append(0)
+                    continue
+                precision = 1.0 * num_same / len(prediction_tokens)
+                recall = 1.0 * num_same / num_truth_tokens
+                f1.append((2 * precision * recall) / (precision + recall))
+            scores.append((max(exact_match), max(f1)))
+        return scores
 
-def exact_match_score(prediction, ground_truth):
-    return normalize_answer(prediction) == normalize_answer(ground_truth)
+    def evaluate(self, answer_dict):
+        items = list(answer_dict.items())
+        if self._pool is not None and len(items) > self._num_workers:
+            size = (len(items) + self._num_workers * 4 - 1) // (self._num_workers * 4)
+            chunks = self._pool.map(_score_chunk, [items[i: i + size] for i in range(0, len(items), size)])
+            scores = [score for chunk in chunks for score in chunk]
+        else:
+            scores = self.score(items)
+        # summed in the order of answer_dict, as evaluate always did
+        f1 = exact_match = total = 0
+        for em, f in scores:
+            total += 1
+            exact_match += em
+            f1 += f
+        exact_match = 100.0 * exact_match / total
+        f1 = 100.0 * f1 / total
+        return {'exact_match': exact_match, 'f1': f1}
 
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
-def metric_max_over_ground_truths(metric_fn, prediction, ground_truths):
-    scores_for_ground_truths = []
-    for ground_truth in ground_truths:
-        score = metric_fn(prediction, ground_truth)
-        scores_for_ground_truths.append(score)
-    return max(scores_for_ground_truths)
+
+# punctuation removed by normalize_answer, deleted with one str.translate
+_PUNC_TABLE = str.maketrans("", "", string.punctuation + '，。！？·、：；（）【】{}““’')
+_ARTICLES = re.compile(r'\b(a|an|the)\b')
+
+
+def normalize_answer(s):
+    # lower, remove punctuation, remove articles, fix white spaces
+    return ' '.join(_ARTICLES.sub(' ', s.lower().translate(_PUNC_TABLE)).split())